@@ -1,9 +1,3 @@
-import subprocess
-import sys
-
-# Force install required packages — fixes Streamlit Cloud environment issues
-subprocess.run([sys.executable, "-m", "pip", "install", "openpyxl==3.1.5", "xlrd==2.0.1", "et-xmlfile", "-q"], check=False)
-
 import streamlit as st
 import pandas as pd
 import numpy as np
@@ -11,11 +5,32 @@ import os
 import time
 from datetime import datetime
 import io
-import base64
+import copy
+import csv
+import gzip
+import hashlib
+import itertools
+import importlib.metadata
+import importlib.util
 import json
+import mmap
+import shutil
+import glob
+import tempfile
+import uuid
+import weakref
 import warnings
+import zipfile
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 warnings.filterwarnings('ignore')
 
+try:
+    import pyarrow as pa
+except ImportError:  # optional — parse cache, merged-store partitions and columnar exports
+    pa = None
+
 # ─────────────────────────────────────────
 # PAGE CONFIG
 # ─────────────────────────────────────────
@@ -84,18 +99,15 @@ st.markdown("""
     .mapping-row.unmapped { border-left-color: #F59E0B; }
 
     /* ---- Download button ---- */
-    .dl-btn {
-        display: inline-block;
+    [data-testid="stDownloadButton"] button {
         background: linear-gradient(135deg, #10B981, #059669);
         color: white !important;
-        padding: 0.65rem 1.5rem;
+        border: none;
         border-radius: 8px;
         font-weight: 700;
-        text-decoration: none !important;
-        font-size: 0.95rem;
         transition: all .2s;
     }
-    .dl-btn:hover { box-shadow: 0 4px 12px rgba(16,185,129,.4); transform: translateY(-1px); }
+    [data-testid="stDownloadButton"] button:hover { box-shadow: 0 4px 12px rgba(16,185,129,.4); transform: translateY(-1px); }
 
     /* ---- Step indicator ---- */
     .step-active   { background: linear-gradient(135deg,#3B82F6,#8B5CF6); color:white; }
@@ -140,11 +152,15 @@ st.markdown("""
 def init_state():
     defaults = {
         'step': 1,
-        'uploaded_files': [],
-        'file_dataframes': {},       # {filename: df}
+        'upload_groups': {},         # {upload signature: [SourceFile]}
+        'sources': {},               # {filename: SourceFile}
         'all_columns': [],           # union of all columns
         'column_mapping': {},        # {target_col: {source_file: source_col}}
         'merged_data': None,
+        'merged_token': None,        # fingerprint of merged_data (new for every merge)
+        'column_profile': None,      # ColumnProfile of merged_data
+        'merged_memory': None,       # (bytes before, after dtype optimisation) of an in-memory merge
+        'merge_state': None,         # how merged_data was built — see append_to_merge()
         'page': 'app',               # 'app' | 'features'
         'mapping_confirmed': False,
     }
@@ -155,71 +171,329 @@ def init_state():
 init_state()
 
 
+# ─────────────────────────────────────────
+# DEPENDENCIES
+# ─────────────────────────────────────────
+# Optional packages and what needs them. None of them is imported at startup:
+# pandas imports the Excel engines on first use, and require() turns a missing
+# one into a clear error instead of an ImportError deep inside pandas.
+OPTIONAL_DEPS = {
+    'openpyxl': "Excel (.xlsx) import and export",
+    'xlrd':     "legacy Excel (.xls) import",
+    'pyarrow':  "Parquet / Feather files, the ingest cache and the streaming merge engine",
+    'zstandard': "zstd-compressed import and CSV export",
+    'python_calamine': "fast (Rust) Excel import",
+    'duckdb':   "the SQL tab and the parallel pivot / group-by engine",
+}
+
+
+@st.cache_resource(show_spinner=False)
+def probe_dependencies():
+    """
+    One-time startup probe — cached for the life of the server process, so
+    reruns never pay for it. Looks packages up without importing them.
+    Returns {module: installed version or None}.
+    """
+    found = {}
+    for mod in OPTIONAL_DEPS:
+        try:
+            found[mod] = importlib.metadata.version(mod) if importlib.util.find_spec(mod) else None
+        except importlib.metadata.PackageNotFoundError:
+            found[mod] = None
+    return found
+
+
+def require(module):
+    """Raise a readable ImportError when an optional package needed right now is missing."""
+    if importlib.util.find_spec(module) is None:
+        raise ImportError(f"'{module}' is needed for {OPTIONAL_DEPS[module]} — install it with `pip install {module}`")
+
+
 # ─────────────────────────────────────────
 # HELPERS
 # ─────────────────────────────────────────
 CHUNK_SIZE = 50_000  # rows per chunk for large file display
 
 
-def read_file(uploaded_file):
-    """Read an uploaded file into a DataFrame."""
-    name = uploaded_file.name
-    ext  = os.path.splitext(name)[1].lower()
-    try:
-        if ext == '.csv':
-            return pd.read_csv(uploaded_file)
-        elif ext in ('.xlsx', '.xls'):
-            return pd.read_excel(uploaded_file)
-        elif ext == '.json':
-            return pd.read_json(uploaded_file)
-        elif ext == '.txt':
-            content = uploaded_file.getvalue().decode('utf-8')
-            for sep in (',', '\t', '|', ';'):
-                try:
-                    df = pd.read_csv(io.StringIO(content), sep=sep)
-                    if df.shape[1] > 1:
-                        return df
-                except Exception:
-                    pass
-            return pd.read_csv(io.StringIO(content), sep=None, engine='python')
+EXPORT_DIR       = os.environ.get("FMP_EXPORT_DIR",
+                                  os.path.join(tempfile.gettempdir(), "file_merger_pro_exports"))
+EXPORT_MAX_BYTES = int(os.environ.get("FMP_EXPORT_MAX_MB", "4096")) * 1024 * 1024
+EXPORT_CSV_ROWS  = 100_000  # rows per block written by the CSV exporter
+EXCEL_MAX_ROWS   = 1_048_576  # rows per worksheet, header included
+EXPORT_FORMATS   = {  # fmt: (extension, mime)
+    'csv':     ('csv',     'text/csv'),
+    'csv.gz':  ('csv.gz',  'application/gzip'),
+    'csv.zst': ('csv.zst', 'application/zstd'),
+    'excel':   ('xlsx',    'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'),
+    'workbook': ('xlsx',   'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'),
+    'json':    ('json',    'application/json'),
+    'ndjson':  ('ndjson',  'application/x-ndjson'),
+    'parquet': ('parquet', 'application/vnd.apache.parquet'),
+    'feather': ('feather', 'application/vnd.apache.arrow.file'),
+}
+
+
+def evict_lru(root, max_bytes, suffix="", keep=None):
+    """
+    Delete the least-recently-used `*suffix` files in `root` until they fit
+    in `max_bytes`. `keep` (a path) counts towards the total but is never deleted.
+    """
+    if not os.path.isdir(root):
+        return
+    entries = []
+    for entry in os.scandir(root):
+        if entry.name.endswith(suffix) and entry.is_file():
+            st_ = entry.stat()
+            entries.append((st_.st_mtime, st_.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        if path == keep:
+            continue
+        try:
+            os.remove(path)
+            total -= size
+        except FileNotFoundError:
+            pass
+
+
+def iter_blocks(df, rows=None, block_rows=EXPORT_CSV_ROWS):
+    """
+    `df` (DataFrame or MergedStore, optionally restricted to positional
+    `rows`) as consecutive frames of at most `block_rows` rows — a store
+    partition at a time, never the whole selection at once.
+    """
+    if is_store(df):
+        yield from df.iter_frames(rows=rows)
+        return
+    n = len(df) if rows is None else len(rows)
+    for start in range(0, n, block_rows):
+        if rows is None:
+            yield df.iloc[start:start + block_rows]
         else:
-            try:
-                return pd.read_csv(uploaded_file)
-            except Exception:
-                return pd.read_excel(uploaded_file)
-    except Exception as e:
-        st.warning(f"⚠️ Could not read **{name}**: {e}")
-        return None
+            yield df.take(rows[start:start + block_rows])
 
 
-def to_download_link(df, fmt, filename):
-    """Return an HTML <a> download link."""
-    if fmt == 'csv':
-        data  = df.to_csv(index=False, encoding='utf-8-sig').encode('utf-8-sig')
-        mime  = 'text/csv'
-        ext   = 'csv'
+def open_csv_export(path, fmt):
+    """Text handle for a CSV export: plain, gzip ('csv.gz') or zstd ('csv.zst') compressed."""
+    if fmt == 'csv.gz':
+        return gzip.open(path, 'wt', encoding='utf-8-sig', newline='')
+    if fmt == 'csv.zst':
+        require('zstandard')
+        import zstandard
+        raw = open(path, 'wb')
+        return io.TextIOWrapper(zstandard.ZstdCompressor(level=3, threads=-1).stream_writer(raw),
+                                encoding='utf-8-sig', newline='')
+    return open(path, 'w', encoding='utf-8-sig', newline='')
+
+
+def write_export(df, fmt, path, rows=None):
+    """
+    Serialise `df` (DataFrame or MergedStore, optionally restricted to
+    positional `rows`) straight to the file at `path`.
+    CSV (compressed on the fly for csv.gz / csv.zst), JSON and NDJSON are
+    streamed block by block, so memory stays at one block whatever the
+    export size.
+    """
+    if fmt.startswith('csv'):
+        with open_csv_export(path, fmt) as fh:
+            written = 0
+            for written, block in enumerate(iter_blocks(df, rows), 1):
+                block.to_csv(fh, index=False, header=(written == 1))
+            if not written:  # nothing selected — still a header row, as df.to_csv would write
+                pd.DataFrame(columns=df.columns).to_csv(fh, index=False)
     elif fmt == 'excel':
-        buf = io.BytesIO()
-        with pd.ExcelWriter(buf, engine='openpyxl') as w:
-            df.to_excel(w, index=False, sheet_name='MergedData')
-        data = buf.getvalue()
-        mime = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-        ext  = 'xlsx'
-    else:  # json
-        data = df.to_json(orient='records', indent=2, force_ascii=False).encode()
-        mime = 'application/json'
-        ext  = 'json'
-
-    b64  = base64.b64encode(data).decode()
+        write_excel([('MergedData', df, rows)], path)
+    elif fmt == 'workbook':  # df is a list of (sheet name, data, rows)
+        write_excel(df, path)
+    elif fmt in ('parquet', 'feather'):
+        require('pyarrow')
+        write_columnar(df, fmt, path, rows)
+    elif fmt == 'ndjson':
+        with open(path, 'w', encoding='utf-8') as fh:
+            for block in iter_blocks(df, rows):
+                if len(block):
+                    fh.write(block.to_json(orient='records', lines=True, force_ascii=False).rstrip('\n') + '\n')
+    else:  # json — one compact array, streamed block by block
+        with open(path, 'w', encoding='utf-8') as fh:
+            fh.write('[')
+            first = True
+            for block in iter_blocks(df, rows):
+                body = block.to_json(orient='records', force_ascii=False)[1:-1]
+                if body:
+                    fh.write(body if first else ',' + body)
+                    first = False
+            fh.write(']')
+
+
+def excel_rows(frame):
+    """Rows of `frame` as tuples of plain Python values; missing values become empty cells."""
+    cols = []
+    for c in frame.columns:
+        s = frame[c]
+        if isinstance(s.dtype, pd.DatetimeTZDtype):
+            s = s.dt.tz_localize(None)  # Excel has no time zones
+        vals = s.to_numpy(dtype=object, copy=True)
+        vals[s.isna().to_numpy()] = None
+        cols.append(vals)
+    return zip(*cols)
+
+
+def write_excel(sheets, path):
+    """
+    Streaming xlsx writer (openpyxl write-only mode): rows go straight to
+    the compressed sheet files instead of a cell object tree, so memory
+    stays at one block however large the workbook. A table longer than one
+    worksheet continues on `name_1`, `name_2`, ….
+    `sheets` is a list of (name, data, rows) — data a DataFrame or store,
+    rows optional positional ids — all written in a single pass.
+    """
+    require('openpyxl')
+    import openpyxl
+    wb        = openpyxl.Workbook(write_only=True)
+    per_sheet = EXCEL_MAX_ROWS - 1
+    for name, data, rows in sheets:
+        n      = len(data) if rows is None else len(rows)
+        split  = n > per_sheet
+        header = [str(c) for c in data.columns]
+        ws, written, sheet_no = None, per_sheet, 0
+        for block in iter_blocks(data, rows):
+            for row in excel_rows(block):
+                if written == per_sheet:
+                    sheet_no += 1
+                    ws = wb.create_sheet(f"{name}_{sheet_no}" if split else name)
+                    ws.append(header)
+                    written = 0
+                ws.append(row)
+                written += 1
+        if ws is None:
+            wb.create_sheet(name).append(header)
+    wb.save(path)
+
+
+def arrow_table(frame):
+    """frame as a pyarrow Table; mixed-type object columns (numbers and text from Excel) become text."""
+    frame = frame.rename(columns=str)
+    try:
+        return pa.Table.from_pandas(frame, preserve_index=False)
+    except (pa.ArrowException, TypeError, ValueError):
+        mixed = [c for c in frame.columns if frame[c].dtype == object]
+        return pa.Table.from_pandas(frame.astype({c: "string" for c in mixed}), preserve_index=False)
+
+
+def write_columnar(df, fmt, path, rows=None):
+    """
+    Parquet (zstd) or Feather / Arrow IPC (zstd) export. A store is written
+    partition by partition — one row group / record batch each — cast to a
+    schema all partitions fit, so memory stays at one partition.
+    """
+    import pyarrow.parquet as pq
+    if is_store(df):
+        schema = df.arrow_schema()
+        tables = (arrow_table(part).cast(schema) for part in df.iter_frames(rows=rows))
+    else:
+        table  = arrow_table(load_columns(df, rows=rows))
+        schema, tables = table.schema, [table]
+    if fmt == 'parquet':
+        writer = pq.ParquetWriter(path, schema, compression='zstd')
+    else:
+        writer = pa.ipc.new_file(path, schema, options=pa.ipc.IpcWriteOptions(compression='zstd'))
+    with writer:
+        for table in tables:
+            writer.write_table(table)
+
+
+def export_file(df, fmt, token, rows=None):
+    """
+    Path of the export of `df` as `fmt`, written on first request only.
+    Exports are cached on disk per (data fingerprint, format), so repeated
+    downloads of unchanged data cost nothing.
+    """
+    ext, _ = EXPORT_FORMATS[fmt]
+    key  = hashlib.sha256(repr((token, fmt)).encode()).hexdigest()
+    path = os.path.join(EXPORT_DIR, f"{key}.{ext}")
+    if os.path.exists(path):
+        os.utime(path)
+        return path
+    # One budget across every format: make room first, then settle it with the new file counted in
+    evict_lru(EXPORT_DIR, EXPORT_MAX_BYTES)
+    staging = os.path.join(EXPORT_DIR, "partial")  # outside evict_lru's reach while being written
+    os.makedirs(staging, exist_ok=True)
+    tmp = os.path.join(staging, f"{uuid.uuid4().hex}.{ext}")
+    try:
+        write_export(df, fmt, tmp, rows)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    evict_lru(EXPORT_DIR, EXPORT_MAX_BYTES, keep=path)
+    return path
+
+
+def export_button(df, fmt, filename, token, key, rows=None):
+    """
+    Download button whose file is produced lazily: nothing is serialised
+    while the page renders, only when the button is clicked. The export is
+    written to disk in bounded memory (see export_file), but Streamlit's
+    download button serves bytes, so the finished file is read into memory
+    for the duration of the download.
+    """
+    ext, mime = EXPORT_FORMATS[fmt]
+    full = f"{filename}.{ext}"
+
+    def _read():
+        with open(export_file(df, fmt, token, rows), 'rb') as fh:
+            return fh.read()
+
+    st.download_button(
+        f"📥 Download {full}",
+        data=_read,
+        file_name=full,
+        mime=mime,
+        key=key,
+        on_click="ignore",
+    )
+    return full
+
+
+def workbook_button(sheets, filename, key):
+    """
+    Download button for one workbook holding several result tables.
+    `sheets` is a live {sheet name: (cache key, data, rows)} registry that
+    the sections keep current; it is read when the button is clicked, so
+    tables re-rendered by a fragment since then are included as shown.
+    """
+    ext, mime = EXPORT_FORMATS['workbook']
     full = f"{filename}.{ext}"
-    return f'<a class="dl-btn" href="data:{mime};base64,{b64}" download="{full}">📥 Download {full}</a>', full
+
+    def _read():
+        current = list(sheets.items())
+        token   = tuple((name, k) for name, (k, _, _) in current)
+        parts   = [(name, data, rows) for name, (_, data, rows) in current]
+        with open(export_file(parts, 'workbook', token), 'rb') as fh:
+            return fh.read()
+
+    st.download_button(
+        f"📦 Download {full}",
+        data=_read,
+        file_name=full,
+        mime=mime,
+        key=key,
+        on_click="ignore",
+    )
+    return full
 
 
-def chunked_display(df, key_prefix=""):
-    """Display large DataFrames in chunks with pagination."""
-    total = len(df)
+def chunked_display(df, key_prefix="", rows=None):
+    """
+    Display large DataFrames in chunks with pagination.
+    `df` may also be a MergedStore; only the visible page is read.
+    `rows` optionally restricts the display to those positional rows.
+    """
+    total = len(df) if rows is None else len(rows)
     if total <= CHUNK_SIZE:
-        st.dataframe(df, use_container_width=True)
+        st.dataframe(load_columns(df, rows=rows), use_container_width=True)
         return
 
     n_pages = (total - 1) // CHUNK_SIZE + 1
@@ -230,7 +504,8 @@ def chunked_display(df, key_prefix=""):
     start = (page - 1) * CHUNK_SIZE
     end   = min(start + CHUNK_SIZE, total)
     st.caption(f"Showing rows {start+1:,} – {end:,} of {total:,}")
-    st.dataframe(df.iloc[start:end], use_container_width=True)
+    page_rows = np.arange(start, end) if rows is None else rows[start:end]
+    st.dataframe(load_columns(df, rows=page_rows), use_container_width=True)
 
 
 def step_indicator():
@@ -257,104 +532,1053 @@ def back_button(target_step, label="← Back"):
         st.rerun()
 
 
+# ─────────────────────────────────────────
+# MEMORY OPTIMISATION
+# ─────────────────────────────────────────
+CATEGORY_MAX_RATIO = 0.5  # text becomes categorical when distinct values are at most this share of the rows
+
+
+def frame_nbytes(df):
+    """Memory held by a frame, strings included."""
+    return int(df.memory_usage(index=False, deep=True).sum())
+
+
+def optimise_column(s):
+    """
+    The smallest lossless dtype for one column: integers downcast to the
+    narrowest int, floats to float32 when every value survives the round
+    trip, repetitive text to a categorical and other text to Arrow strings.
+    Anything else (bools, dates, mixed objects) is returned unchanged.
+    """
+    dtype = s.dtype
+    if isinstance(dtype, pd.api.extensions.ExtensionDtype) and not pd.api.types.is_string_dtype(dtype):
+        return s  # nullable ints, categoricals, tz-aware dates ...
+    if pd.api.types.is_bool_dtype(dtype):
+        return s
+    if pd.api.types.is_integer_dtype(dtype):
+        return pd.to_numeric(s, downcast='unsigned' if len(s) and s.min() >= 0 else 'integer')
+    if pd.api.types.is_float_dtype(dtype):
+        if dtype == np.float64:
+            f32 = s.astype(np.float32)
+            if np.array_equal(f32.to_numpy(dtype=np.float64), s.to_numpy(), equal_nan=True):
+                return f32
+        return s
+    if pd.api.types.is_string_dtype(dtype) and (dtype != object or pd.api.types.infer_dtype(s, skipna=True) == 'string'):
+        if s.nunique(dropna=True) <= CATEGORY_MAX_RATIO * len(s):
+            return s.astype('category')
+        if dtype == object and pa is not None:
+            return s.astype(pd.StringDtype('pyarrow'))
+    return s
+
+
+def optimise_dtypes(df):
+    """`df` with every column in its smallest lossless dtype (see optimise_column)."""
+    cols = {col: optimise_column(df[col]) for col in df.columns}
+    return pd.DataFrame(cols, index=df.index, columns=df.columns, copy=False)
+
+
+def memory_estimate(sample, n_rows):
+    """(bytes as parsed, bytes optimised) for `n_rows` rows, extrapolated from a parsed sample."""
+    if not len(sample) or n_rows is None:
+        return None
+    scale = n_rows / len(sample)
+    return int(frame_nbytes(sample) * scale), int(frame_nbytes(optimise_dtypes(sample)) * scale)
+
+
+def format_bytes(n):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if n < 1024 or unit == 'GB':
+            return f"{n:,.0f} {unit}" if unit == 'B' else f"{n:,.1f} {unit}"
+        n /= 1024
+
+
 # ─────────────────────────────────────────
 # STEP 1 – UPLOAD
 # ─────────────────────────────────────────
-def read_file_safe(uploaded_file):
-    """Read uploaded file — uses same logic as original working code."""
+INGEST_WORKERS = max(1, min(8, os.cpu_count() or 1))  # parallel parsers (upload probe and merge-time parse)
+
+# Parsed-frame cache — survives reruns, new sessions and re-uploads of the same bytes
+INGEST_CACHE_DIR       = os.environ.get("FMP_CACHE_DIR",
+                                        os.path.join(tempfile.gettempdir(), "file_merger_pro_cache"))
+INGEST_CACHE_MAX_BYTES = int(os.environ.get("FMP_CACHE_MAX_MB", "2048")) * 1024 * 1024
+INGEST_READER_VERSION  = 3  # bump whenever parse_file_bytes() output changes
+
+# Server-side ingestion — files already on this host are read in place, never uploaded
+DATA_ROOT        = os.environ.get("FMP_DATA_ROOT")  # unset = uploads only
+MAX_SERVER_FILES = 500
+
+SNIFF_BYTES    = 256 * 1024     # sample used to detect encoding / delimiter / quoting
+SAMPLE_ROWS    = 1_000          # rows parsed at upload time — enough for dtypes and the summary
+COLUMNAR_EXTS  = ('.parquet', '.feather', '.arrow')  # typed formats read through pyarrow — never re-cached
+EXCEL_EXTS     = ('.xlsx', '.xls')
+JSON_EXTS      = ('.json', '.ndjson', '.jsonl')
+SOURCE_EXTS    = ('.csv', '.txt', '.json', '.ndjson', '.jsonl') + EXCEL_EXTS + COLUMNAR_EXTS
+ARCHIVE_CODECS = {'.gz': 'gzip', '.zst': 'zstd'}  # single compressed files; .zip archives hold several sources
+EXCEL_ENGINE   = 'calamine' if importlib.util.find_spec('python_calamine') else None  # None = pandas default
+TXT_DELIMITERS = ",\t|;"
+
+
+def byte_source(data):
+    """
+    What the readers open: a BytesIO over in-memory bytes, or — for a file
+    on the server, given by its path — the path itself, read from disk.
+    """
+    return data if isinstance(data, str) else io.BytesIO(data)
+
+
+def arrow_source(data):
+    """pyarrow input over in-memory bytes (zero-copy) or over a server file, memory-mapped."""
+    return pa.memory_map(data) if isinstance(data, str) else pa.BufferReader(data)
+
+
+def head_bytes(data, n):
+    """The first `n` bytes of in-memory bytes, a server file or a member of one."""
+    if isinstance(data, (str, tuple)):
+        with open_raw(data) as fh:
+            return fh.read(n)
+    return data[:n]
+
+
+def detect_encoding(sample):
+    """Encoding of a text sample: BOM first, then strict UTF-8, else Windows-1252."""
+    if sample.startswith(b'\xef\xbb\xbf'):
+        return 'utf-8-sig'
+    if sample.startswith((b'\xff\xfe', b'\xfe\xff')):
+        return 'utf-16'
+    for cut in range(4):  # the sample may end in the middle of a multi-byte character
+        try:
+            sample[:len(sample) - cut].decode('utf-8')
+            return 'utf-8'
+        except UnicodeDecodeError:
+            continue
+    return 'cp1252'
+
+
+def sniff_dialect(text):
+    """
+    (delimiter, quotechar) of delimited text. csv.Sniffer first; when it
+    gives up, the candidate delimiter that splits the most lines into the
+    same (largest) number of fields wins.
+    """
+    try:
+        d = csv.Sniffer().sniff(text, delimiters=TXT_DELIMITERS)
+        return d.delimiter, d.quotechar or '"'
+    except csv.Error:
+        pass
+    lines = [ln for ln in text.splitlines()[:200] if ln.strip()]
+    best, best_score = ',', (0, 0)
+    for delim in TXT_DELIMITERS:
+        counts = [ln.count(delim) for ln in lines]
+        if not counts or max(counts) == 0:
+            continue
+        mode  = max(set(counts), key=counts.count)
+        score = (counts.count(mode), mode)
+        if mode and score > best_score:
+            best, best_score = delim, score
+    return best, '"'
+
+
+def text_read_options(data):
+    """
+    read_csv options for delimited text (.txt and unknown extensions).
+    Encoding, delimiter and quoting are sniffed from the first SNIFF_BYTES only.
+    """
+    sample   = head_bytes(data, SNIFF_BYTES + 1)
+    partial  = len(sample) > SNIFF_BYTES
+    sample   = sample[:SNIFF_BYTES]
+    encoding = detect_encoding(sample)
+    text     = sample.decode(encoding, errors='ignore')
+    if partial:
+        text = text[:text.rfind('\n') + 1] or text  # drop the partial last line
+    delimiter, quotechar = sniff_dialect(text)
+    return {'sep': delimiter, 'quotechar': quotechar, 'encoding': encoding}
+
+
+def read_delimited_text(data, **kwargs):
+    """
+    Single-pass reader for delimited text: the dialect is sniffed from a
+    sample, then the file is parsed once by the C engine straight from the
+    byte buffer — never decoded into one big Python string.
+    """
+    return pd.read_csv(byte_source(data), **text_read_options(data), **kwargs)
+
+
+def read_columnar(file_ext, data, columns=None, nrows=None):
+    """
+    Parquet / Arrow IPC (Feather v2) bytes as a pyarrow Table. Only
+    `columns` are decoded, and with `nrows` only the leading row groups /
+    record batches holding those rows; uncompressed IPC is read zero-copy,
+    from memory or from a memory-mapped server file.
+    """
+    if file_ext == '.parquet':
+        import pyarrow.parquet as pq
+        pf = pq.ParquetFile(arrow_source(data))
+        if nrows is None:
+            return pf.read(columns=columns)
+        batch = next(pf.iter_batches(batch_size=max(nrows, 1), columns=columns), None)
+        if batch is not None:
+            return pa.Table.from_batches([batch]).slice(0, nrows)
+        table = pf.schema_arrow.empty_table()
+    else:
+        try:
+            reader  = pa.ipc.open_file(arrow_source(data))
+            batches = (reader.get_batch(i) for i in range(reader.num_record_batches))
+        except pa.ArrowInvalid:  # IPC stream rather than file format
+            reader  = pa.ipc.open_stream(arrow_source(data))
+            batches = iter(reader)
+        taken = []
+        for batch in batches:
+            taken.append(batch)
+            if nrows is not None and sum(b.num_rows for b in taken) >= nrows:
+                break
+        table = pa.Table.from_batches(taken, schema=reader.schema)
+    if columns is not None:
+        table = table.select(list(columns))
+    return table if nrows is None else table.slice(0, nrows)
+
+
+def excel_sheet_names(filename, data):
+    """Worksheet names of a workbook, read from its metadata — no cells are parsed."""
+    file_ext = os.path.splitext(filename)[1].lower()
+    if EXCEL_ENGINE is None:
+        require('xlrd' if file_ext == '.xls' else 'openpyxl')
+    with pd.ExcelFile(byte_source(data), engine=EXCEL_ENGINE) as xl:
+        return list(xl.sheet_names)
+
+
+def is_ndjson(filename, data):
+    """
+    Newline-delimited JSON? Always for .ndjson / .jsonl; for .json when the
+    first line is a complete object and the next non-blank line opens another.
+    """
+    if os.path.splitext(filename)[1].lower() in ('.ndjson', '.jsonl'):
+        return True
+    head = head_bytes(data, SNIFF_BYTES).lstrip(b'\xef\xbb\xbf \t\r\n')
+    if not head.startswith(b'{'):
+        return False
+    first, _, rest = head.partition(b'\n')
+    try:
+        if not isinstance(json.loads(first), dict):
+            return False
+    except ValueError:
+        return False
+    return rest.lstrip().startswith(b'{')
+
+
+def flatten_table(table):
+    """Struct (nested object) columns of an Arrow table expanded into dotted columns, recursively."""
+    while any(pa.types.is_struct(t) for t in table.schema.types):
+        table = table.flatten()
+    return table
+
+
+def flatten_nested(df):
+    """
+    Columns holding JSON objects expanded into dotted columns (`user.id`,
+    `user.geo.lat`, …), recursively — one from_records per nested column
+    rather than a json_normalize walk per row.
+    """
+    out, nested = {}, False
+    for c in df.columns:
+        s    = df[c]
+        vals = s.dropna()
+        if s.dtype == object and len(vals) and vals.map(type).eq(dict).all():
+            nested = True
+            inner  = pd.DataFrame.from_records([v if isinstance(v, dict) else {} for v in s], index=df.index)
+            for ic, col in flatten_nested(inner).items():
+                out[f"{c}.{ic}"] = col
+        else:
+            out[c] = s
+    return pd.DataFrame(out, index=df.index) if nested else df
+
+
+def read_ndjson(data, columns=None, nrows=None):
+    """
+    NDJSON bytes as a flat DataFrame: pyarrow's multithreaded JSON reader
+    with struct flattening when available, pandas `lines=True` otherwise.
+    With `nrows` only the leading lines are parsed.
+    """
+    if nrows is not None:
+        with open_payload(data) as fh:
+            data = b''.join(itertools.islice(fh, nrows))
+    if pa is not None:
+        import pyarrow.json as pj
+        try:
+            return project_frame(flatten_table(pj.read_json(arrow_source(data))).to_pandas(), columns, nrows)
+        except pa.ArrowInvalid:
+            pass  # e.g. a field changing type between records — pandas falls back to object columns
+    return project_frame(flatten_nested(pd.read_json(byte_source(data), lines=True)), columns, nrows)
+
+
+def iter_ndjson(stream, columns, chunk_rows):
+    """Parse an NDJSON stream in blocks of `chunk_rows` lines — one block in memory at a time."""
+    while True:
+        block = b''.join(itertools.islice(stream, chunk_rows))
+        if not block:
+            return
+        if block.strip():
+            yield read_ndjson(block, columns)
+
+
+def read_json_bytes(filename, data, columns=None, nrows=None):
+    """JSON document or NDJSON (detected) as a flat DataFrame."""
+    if is_ndjson(filename, data):
+        return read_ndjson(data, columns, nrows)
     try:
-        filename = uploaded_file.name
-        file_ext = os.path.splitext(filename)[1].lower()
+        df = pd.read_json(byte_source(data))
+    except ValueError:
+        return read_ndjson(data, columns, nrows)  # NDJSON whose first record outgrew the sniff sample
+    return project_frame(flatten_nested(df), columns, nrows)
+
+
+def parse_file_bytes(filename, data, columns=None, nrows=None, sheet=None):
+    """
+    Parse raw file bytes into a DataFrame — same logic as the original working code.
+    `columns` limits the parse to those columns and `nrows` to the first
+    rows; both are pushed down to the reader where it supports them, so
+    skipped columns are never converted. `sheet` picks an Excel worksheet
+    (default: the first). Excel goes through calamine when installed.
+    Makes no Streamlit calls, so it is safe to run on a worker thread.
+    Raises on failure; callers decide how to report it.
+    """
+    file_ext = os.path.splitext(filename)[1].lower()
+    opts = {}
+    if columns is not None:
+        opts['usecols'] = list(columns)
+    if nrows is not None:
+        opts['nrows'] = nrows
+    mm = {'memory_map': True} if isinstance(data, str) else {}  # server files: read_csv maps them
+
+    if file_ext in EXCEL_EXTS and columns is not None:
+        # Excel reads integer entries of a usecols list as positions; match header names instead
+        wanted = set(columns)
+        opts['usecols'] = lambda c: c in wanted
 
+    try:
         if file_ext == '.csv':
-            return filename, pd.read_csv(uploaded_file)
-        elif file_ext in ['.xlsx', '.xls']:
-            return filename, pd.read_excel(uploaded_file)
-        elif file_ext == '.json':
-            return filename, pd.read_json(uploaded_file)
+            return pd.read_csv(byte_source(data), **opts, **mm)
+        elif file_ext in EXCEL_EXTS:
+            if EXCEL_ENGINE is None:
+                require('xlrd' if file_ext == '.xls' else 'openpyxl')
+            return pd.read_excel(byte_source(data), sheet_name=0 if sheet is None else sheet,
+                                 engine=EXCEL_ENGINE, **opts)
+        elif file_ext in JSON_EXTS:
+            return read_json_bytes(filename, data, columns, nrows)
+        elif file_ext in COLUMNAR_EXTS:
+            require('pyarrow')
+            return read_columnar(file_ext, data, columns, nrows).to_pandas()
         elif file_ext == '.txt':
-            content = uploaded_file.getvalue().decode('utf-8')
+            return read_delimited_text(data, **opts, **mm)
+        else:
             try:
-                return filename, pd.read_csv(io.StringIO(content), sep=',')
+                return pd.read_csv(byte_source(data), **opts, **mm)
             except:
                 try:
-                    return filename, pd.read_csv(io.StringIO(content), sep='\t')
+                    return pd.read_excel(byte_source(data), **opts)
                 except:
-                    return filename, pd.read_csv(io.StringIO(content), sep=None, engine='python')
+                    return read_delimited_text(data, **opts, **mm)
+    except ValueError:
+        if columns is None:
+            raise
+        # Header names the reader can't match one-to-one (duplicates, mangled names): parse everything, then project
+        return project_frame(parse_file_bytes(filename, data, nrows=nrows, sheet=sheet), columns, nrows)
+
+
+def project_frame(df, columns=None, nrows=None):
+    """df limited to `columns` (those it has) and its first `nrows` rows."""
+    if columns is not None:
+        df = df[[c for c in df.columns if c in set(columns)]]
+    return df if nrows is None else df.head(nrows)
+
+
+def count_rows(filename, data, sheet=None):
+    """
+    (data rows, exact?) without parsing: file metadata for Parquet / Arrow,
+    newlines for delimited text (quoted line breaks and blank lines
+    over-count), sheet dimensions for Excel. (None, False) when the format
+    gives no cheap answer.
+    """
+    file_ext = os.path.splitext(filename)[1].lower()
+    try:
+        if file_ext == '.parquet':
+            import pyarrow.parquet as pq
+            return pq.ParquetFile(arrow_source(data)).metadata.num_rows, True
+        if file_ext in COLUMNAR_EXTS:
+            return read_columnar(file_ext, data, columns=[]).num_rows, True
+        if file_ext == '.xlsx':
+            import openpyxl
+            wb = openpyxl.load_workbook(byte_source(data), read_only=True)
+            try:
+                ws = wb.worksheets[0] if sheet is None else wb[sheet]
+                return max(0, (ws.max_row or 0) - 1), False
+            finally:
+                wb.close()
+        if file_ext == '.xls':
+            import xlrd
+            book = (xlrd.open_workbook(filename=data, on_demand=True) if isinstance(data, str)
+                    else xlrd.open_workbook(file_contents=data, on_demand=True))
+            ws   = book.sheet_by_index(0) if sheet is None else book.sheet_by_name(sheet)
+            return max(0, ws.nrows - 1), False
+        if file_ext in ['.csv', '.txt'] or file_ext in JSON_EXTS and is_ndjson(filename, data):
+            if isinstance(data, str):
+                with open(data, 'rb') as fh:
+                    lines = count_lines(fh)
+            else:
+                lines = data.count(b'\n') + (0 if not data or data.endswith(b'\n') else 1)
+            return max(0, lines - (file_ext not in JSON_EXTS)), False  # minus the header line
+    except Exception:
+        pass
+    return None, False
+
+
+def ingest_cache_key(digest, ext, options=None):
+    """
+    Cache key for a parsed file: hash of the raw bytes (`digest`) plus
+    everything that influences how they are parsed (extension, reader
+    options such as the column projection, reader version).
+    The file *name* is deliberately not part of it — the same bytes uploaded
+    under another name reuse the cached frame.
+    """
+    h = hashlib.sha256(digest.encode())
+    opts = {"ext": ext, "v": INGEST_READER_VERSION, **(options or {})}
+    h.update(json.dumps(opts, sort_keys=True, default=str).encode())
+    return h.hexdigest()
+
+
+class IngestCache:
+    """
+    Parsed-frame cache on local disk: one Parquet file per cache key.
+    Every hit refreshes the file's mtime, so eviction (oldest mtime first,
+    until the directory fits in `max_bytes`) is least-recently-used.
+    Disabled when pyarrow is missing; frames Parquet can't hold are simply not cached.
+    """
+
+    def __init__(self, root, max_bytes):
+        self.root      = root
+        self.max_bytes = max_bytes
+
+    @property
+    def enabled(self):
+        return pa is not None and self.max_bytes > 0
+
+    def _path(self, key):
+        return os.path.join(self.root, f"{key}.parquet")
+
+    def get(self, key, columns=None):
+        """The cached frame (only `columns` of it, if given — Parquet reads just those), or None."""
+        if not self.enabled:
+            return None
+        path = self._path(key)
+        try:
+            df = pd.read_parquet(path, columns=None if columns is None else list(columns))
+            os.utime(path)
+            return df
+        except (OSError, KeyError, ValueError, pa.ArrowException):
+            return None
+
+    def put(self, key, df):
+        """Store a frame atomically. Safe to call from worker threads."""
+        if not self.enabled:
+            return
+        path = self._path(key)
+        tmp  = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            os.makedirs(self.root, exist_ok=True)
+            df.to_parquet(tmp, index=False)
+            os.replace(tmp, path)
+        except Exception:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def evict(self):
+        """Drop least-recently-used entries until the cache fits its size budget."""
+        if self.enabled:
+            evict_lru(self.root, self.max_bytes, ".parquet")
+
+
+INGEST_CACHE = IngestCache(INGEST_CACHE_DIR, INGEST_CACHE_MAX_BYTES)
+
+
+class SliceReader(io.RawIOBase):
+    """Readable stream over `size` bytes at `offset` of a server file — a zip member read in place."""
+
+    def __init__(self, path, offset, size):
+        self._fh   = open(path, 'rb')
+        self._left = size
+        self._fh.seek(offset)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        n = self._fh.readinto(memoryview(b)[:min(len(b), self._left)]) if self._left else 0
+        self._left -= n
+        return n
+
+    def close(self):
+        self._fh.close()
+        super().close()
+
+
+def open_raw(data):
+    """Binary stream over in-memory bytes, a server file (path) or a member of one ((path, offset, size))."""
+    if isinstance(data, tuple):
+        return io.BufferedReader(SliceReader(*data), 1 << 20)
+    return open(data, 'rb') if isinstance(data, str) else io.BytesIO(data)
+
+
+class InflateReader(io.RawIOBase):
+    """Readable stream over raw-deflate bytes (a zip member), inflated incrementally."""
+
+    def __init__(self, data):
+        self._src = open_raw(data)
+        self._z   = zlib.decompressobj(-15)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while True:
+            chunk = self._z.unconsumed_tail or self._src.read(256 * 1024)
+            if not chunk or self._z.eof:
+                return 0
+            out = self._z.decompress(chunk, len(b))
+            if out:
+                b[:len(out)] = out
+                return len(out)
+
+    def close(self):
+        self._src.close()
+        super().close()
+
+
+def open_payload(data, codec=None):
+    """
+    Binary stream over a source's bytes (or server file), decompressed on
+    the fly: gzip, zstd or raw deflate (zip member).
+    """
+    if codec == 'deflate':
+        return io.BufferedReader(InflateReader(data), 1 << 20)
+    raw = open_raw(data)
+    if codec == 'gzip':
+        return gzip.GzipFile(fileobj=raw)
+    if codec == 'zstd':
+        require('zstandard')
+        import zstandard
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(raw, read_across_frames=True), 1 << 20)
+    return raw
+
+
+def count_lines(stream):
+    """Lines in a binary stream (a last line without newline counts), read 1 MB at a time."""
+    lines, last = 0, b'\n'
+    for block in iter(lambda: stream.read(1 << 20), b''):
+        lines += block.count(b'\n')
+        last   = block[-1:]
+    return lines + (last != b'\n')
+
+
+def zip_members(archive, data, path=None):
+    """
+    One SourceFile per data file inside a zip archive. Each member keeps
+    only its own compressed bytes — stored, or raw deflate inflated as a
+    stream when parsed — so members travel to the parse workers
+    individually. Other compression methods are extracted once.
+    A server-side archive (`data` is a path) is memory-mapped to find the
+    members, which then keep just (path, offset, size) and are read in place.
+    """
+    if isinstance(data, str):
+        with open(data, 'rb') as fh, mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return zip_members(archive, mm, path=data)
+    sources = []
+    with zipfile.ZipFile(io.BytesIO(data) if isinstance(data, bytes) else data) as zf:
+        for info in zf.infolist():
+            base = os.path.basename(info.filename)
+            if (info.is_dir() or info.flag_bits & 0x1 or base.startswith('.')
+                    or info.filename.startswith('__MACOSX/')
+                    or os.path.splitext(base)[1].lower() not in SOURCE_EXTS):
+                continue
+            if info.compress_type in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+                head  = data[info.header_offset:info.header_offset + 30]
+                start = info.header_offset + 30 + int.from_bytes(head[26:28], 'little') + int.from_bytes(head[28:30], 'little')
+                payload = (path, start, info.compress_size) if path else data[start:start + info.compress_size]
+                codec   = 'deflate' if info.compress_type == zipfile.ZIP_DEFLATED else None
+            else:
+                payload, codec = zf.read(info), None
+            sources.append(SourceFile(info.filename, payload, codec=codec, name=f"{archive} › {info.filename}"))
+    return sources
+
+
+class SourceFile:
+    """
+    One input file — or one worksheet of a workbook, or one member of an
+    archive — loaded lazily. Upload only probes it: the header, the dtypes
+    of the first SAMPLE_ROWS rows and a row count. The full parse waits
+    until merge time and covers only the columns the mapping uses
+    (load / iter_chunks). Between steps just the raw, still compressed
+    bytes are kept — or only the path of a server file, which is then
+    memory-mapped rather than read. Text formats are decompressed as a
+    stream while being parsed; formats that need random access (Excel,
+    Parquet, Arrow, JSON documents) are inflated for the duration of the parse.
+    Exposes `.columns` and `.dtypes` like a DataFrame, so the mapping
+    helpers take sources and frames alike.
+    """
+
+    def __init__(self, filename, data, sheet=None, digest=None, codec=None, name=None):
+        self.filename = filename  # the file's own name — its extension picks the reader
+        self.sheet    = sheet     # Excel worksheet; None = the first one
+        self.codec    = codec     # None | 'gzip' | 'zstd' | 'deflate' (zip member)
+        self.name     = (name or filename) if sheet is None else f"{name or filename} › {sheet}"
+        self.data     = data      # raw bytes, the path of a server file, or (path, offset, size) of a member
+        self.schema   = None      # set by probe(): columns, dtypes, n_rows, rows_exact
+        self._digest  = digest
+        self._ndjson  = None
+
+    @property
+    def ext(self):
+        return os.path.splitext(self.filename)[1].lower()
+
+    @property
+    def columns(self):
+        return pd.Index(self.schema['columns'] if self.schema else [])
+
+    @property
+    def dtypes(self):
+        return self.schema['dtypes'] if self.schema else pd.Series(dtype=object)
+
+    @property
+    def n_rows(self):
+        """Data rows — exact or estimated (see rows_exact), None when unknown."""
+        return self.schema['n_rows'] if self.schema else None
+
+    @property
+    def rows_exact(self):
+        return bool(self.schema and self.schema['rows_exact'])
+
+    @property
+    def memory(self):
+        """(bytes as parsed, bytes optimised) of the full frame — estimated from the sample — or None."""
+        return self.schema.get('memory') if self.schema else None
+
+    @property
+    def digest(self):
+        """Content hash; for a server file its path, size and mtime (and a member's span) stand in for the bytes."""
+        if self._digest is None:
+            if isinstance(self.data, (str, tuple)):
+                path  = self.data if isinstance(self.data, str) else self.data[0]
+                st_   = os.stat(path)
+                ident = f"{os.path.realpath(path)}|{st_.st_size}|{st_.st_mtime_ns}"
+                if isinstance(self.data, tuple):
+                    ident += f"|{self.data[1]}|{self.data[2]}"
+                self._digest = hashlib.sha256(ident.encode()).hexdigest()
+            else:
+                self._digest = hashlib.sha256(self.data).hexdigest()
+        return self._digest
+
+    @property
+    def is_ndjson(self):
+        if self._ndjson is None:
+            self._ndjson = self.ext in JSON_EXTS and is_ndjson(self.filename, self.head(SNIFF_BYTES))
+        return self._ndjson
+
+    @property
+    def streamable(self):
+        """Read front to back (delimited text, NDJSON) rather than needing the whole payload at once."""
+        return self.ext in ('.csv', '.txt') or self.is_ndjson
+
+    # ── payload ──
+    def open(self):
+        return open_payload(self.data, self.codec)
+
+    def head(self, n):
+        """First `n` bytes of the decompressed payload."""
+        if self.codec is None:
+            return head_bytes(self.data, n)
+        with self.open() as fh:
+            return fh.read(n)
+
+    def content(self):
+        """The whole decompressed payload (a server file stays a path for the readers to map)."""
+        if self.codec is None and not isinstance(self.data, tuple):
+            return self.data
+        with self.open() as fh:
+            return fh.read()
+
+    def cache_key(self, columns=None):
+        cols = None if columns is None else sorted(map(str, columns))
+        return ingest_cache_key(self.digest, self.ext, {"columns": cols, "sheet": self.sheet, "codec": self.codec})
+
+    # ── reading ──
+    def parse(self, columns=None, nrows=None):
+        """Parse the payload (no cache). Compressed text is read as a stream, never inflated whole."""
+        if self.codec is None or not self.streamable:
+            return parse_file_bytes(self.filename, self.content(), columns, nrows, self.sheet)
+        if self.is_ndjson:
+            if nrows is None:
+                return pd.concat(list(iter_ndjson(self.open(), columns, MERGE_CHUNK_ROWS)), ignore_index=True)
+            with self.open() as fh:
+                return read_ndjson(b''.join(itertools.islice(fh, nrows)), columns)
+        opts = text_read_options(self.head(SNIFF_BYTES + 1)) if self.ext == '.txt' else {}
+        try:
+            with self.open() as fh:
+                return pd.read_csv(fh, usecols=columns, nrows=nrows, **opts)
+        except ValueError:
+            if columns is None:
+                raise
+            with self.open() as fh:
+                return project_frame(pd.read_csv(fh, nrows=nrows, **opts), columns)
+
+    def count_rows(self):
+        """(data rows, exact?) — compressed text is counted while streaming through it."""
+        if self.codec is not None and self.streamable:
+            with self.open() as fh:
+                return max(0, count_lines(fh) - (not self.is_ndjson)), False
+        return count_rows(self.filename, self.content(), self.sheet)
+
+    def probe(self):
+        """
+        Read the schema, returning (and storing) it. Formats without a
+        partial reader (JSON documents) are parsed once here and cached for load().
+        """
+        if self.ext in JSON_EXTS and not self.is_ndjson:
+            full   = self.load()
+            sample = full.head(SAMPLE_ROWS)
+            n_rows = len(full)
+            exact  = True
         else:
+            sample = self.parse(nrows=SAMPLE_ROWS)
+            if len(sample) < SAMPLE_ROWS:
+                n_rows, exact = len(sample), True
+            else:
+                n_rows, exact = self.count_rows()
+        self.schema = {
+            'columns':    list(sample.columns),
+            'dtypes':     sample.dtypes,
+            'n_rows':     n_rows,
+            'rows_exact': exact,
+            'memory':     memory_estimate(sample, n_rows),  # (as parsed, optimised) bytes, estimated
+        }
+        return self.schema
+
+    def cached(self, columns=None):
+        """The parsed frame from INGEST_CACHE, or None. A cached full parse serves any projection."""
+        if not INGEST_CACHE.enabled or (self.ext in COLUMNAR_EXTS and self.codec is None):
+            return None
+        df = INGEST_CACHE.get(self.cache_key(columns))
+        if df is None and columns is not None:
+            df = INGEST_CACHE.get(self.cache_key(), columns)
+        return df
+
+    def load(self, columns=None):
+        """Full parse, limited to `columns` — cache first. Safe to call from worker threads."""
+        df = self.cached(columns)
+        if df is None:
+            df = self.parse(columns)
+            if self.ext not in COLUMNAR_EXTS or self.codec is not None:  # plain Parquet/Arrow already is a cache
+                INGEST_CACHE.put(self.cache_key(columns), df)
+        return df
+
+    def iter_chunks(self, columns, chunk_rows):
+        """
+        Yield the parsed source in frames of at most `chunk_rows` rows.
+        CSV/TXT, NDJSON and Parquet are read incrementally, so only one chunk
+        is ever in memory; other formats are loaded once and sliced.
+        """
+        if self.streamable and self.cached(columns) is None:
+            if self.is_ndjson:
+                with self.open() as fh:
+                    yield from iter_ndjson(fh, columns, chunk_rows)
+                return
+            opts = text_read_options(self.head(SNIFF_BYTES + 1)) if self.ext == '.txt' else {}
             try:
-                return filename, pd.read_csv(uploaded_file)
-            except:
-                try:
-                    return filename, pd.read_excel(uploaded_file)
-                except:
-                    content = uploaded_file.getvalue().decode('utf-8')
-                    return filename, pd.read_csv(io.StringIO(content), sep=None, engine='python')
+                with pd.read_csv(self.open(), usecols=columns, chunksize=chunk_rows, **opts) as reader:
+                    yield from reader
+                return
+            except ValueError:
+                pass  # projection the reader can't apply — fall through to load()
+        if self.ext == '.parquet' and pa is not None:
+            import pyarrow.parquet as pq
+            pf = pq.ParquetFile(arrow_source(self.content()))
+            for batch in pf.iter_batches(batch_size=chunk_rows, columns=columns):
+                yield batch.to_pandas()
+            return
+        df = self.load(columns)
+        for start in range(0, len(df), chunk_rows):
+            yield df.iloc[start:start + chunk_rows]
+
+
+def _probe_worker(src):
+    """Worker entry point: probe one source, never raise."""
+    try:
+        return src.name, src.probe(), None
+    except Exception as e:
+        return src.name, None, str(e)
+
+
+def _load_worker(src, columns):
+    """Worker entry point: parse (and cache) one source, never raise."""
+    try:
+        df = src.load(columns)
     except Exception as e:
-        st.warning(f"Could not read {uploaded_file.name}: {str(e)}")
-        return uploaded_file.name, None
+        return src.name, None, str(e)
+    return src.name, df, None
+
+
+def _ingest_executor(n_jobs):
+    """
+    Thread pool for parsing. The Arrow and pandas C parsers, and calamine's
+    Excel reader, release the GIL, so threads parse in parallel without
+    forking the (multi-threaded) server or shipping frames back from another
+    process. openpyxl is pure Python and holds the GIL: without calamine,
+    Excel sources are parsed one at a time.
+    """
+    return ThreadPoolExecutor(max_workers=min(INGEST_WORKERS, n_jobs))
+
+
+def run_ingest_jobs(worker, jobs):
+    """
+    Run worker(*job) for every job — on the ingest pool when there is more
+    than one — yielding the (name, payload, error) results as they finish.
+    """
+    if len(jobs) <= 1 or INGEST_WORKERS <= 1:
+        for job in jobs:
+            yield worker(*job)
+    elif jobs:
+        with _ingest_executor(len(jobs)) as pool:
+            for fut in as_completed([pool.submit(worker, *job) for job in jobs]):
+                yield fut.result()
+
+
+def probe_sources(sources, on_progress=None):
+    """
+    Probe new sources concurrently; each source's schema is filled in place.
+    Returns {name: error message} for the ones that could not be read.
+    `on_progress(done, total, name)` is called in the script thread as each file finishes.
+    """
+    by_name = {src.name: src for src in sources}
+    errors  = {}
+    for done, (name, schema, err) in enumerate(run_ingest_jobs(_probe_worker, [(s,) for s in sources]), 1):
+        if err is None:
+            by_name[name].schema = schema
+        else:
+            errors[name] = err
+        if on_progress:
+            on_progress(done, len(sources), name)
+    if sources:
+        INGEST_CACHE.evict()
+    return errors
+
+
+def load_sources(sources, columns, on_progress=None):
+    """
+    Full parse of every source, limited to columns[name], serving unchanged
+    content from INGEST_CACHE and parsing the misses concurrently.
+    Returns ({name: df} in source order, {name: error message}).
+    """
+    total   = len(sources)
+    results = {}
+    errors  = {}
+
+    def _collect(name, payload, err):
+        if err is None:
+            results[name] = payload
+        else:
+            errors[name] = err
+        if on_progress:
+            on_progress(len(results) + len(errors), total, name)
+
+    # Cache hits load in milliseconds; only the misses go to the parsers
+    todo = []
+    for name, src in sources.items():
+        df = src.cached(columns[name])
+        if df is not None:
+            _collect(name, df, None)
+        else:
+            todo.append((src, columns[name]))
+
+    for result in run_ingest_jobs(_load_worker, todo):
+        _collect(*result)
+    if todo:
+        INGEST_CACHE.evict()
+
+    return {name: results[name] for name in sources if name in results}, errors
+
+
+def upload_signature(f, all_sheets=False):
+    """
+    Identity of one upload: Streamlit's per-upload file_id when available,
+    else name + size — plus, for workbooks, whether sheets are split out.
+    """
+    sig = (f.name, getattr(f, 'file_id', None) or f.size)
+    if os.path.splitext(f.name)[1].lower() in EXCEL_EXTS:
+        sig += (all_sheets,)
+    return sig
+
+
+def path_signature(path, all_sheets=False):
+    """Identity of one server file: path, size and modification time (+ the workbook sheet option)."""
+    st_ = os.stat(path)
+    sig = (path, st_.st_size, st_.st_mtime_ns)
+    if os.path.splitext(path)[1].lower() in EXCEL_EXTS:
+        sig += (all_sheets,)
+    return sig
+
+
+def resolve_server_paths(pattern, root=DATA_ROOT):
+    """
+    Supported files matching a directory or glob pattern (`**` recurses),
+    taken relative to `root`. Anything resolving outside the root — `..`,
+    absolute paths, symlinks pointing elsewhere — is left out.
+    """
+    root   = os.path.realpath(root)
+    target = os.path.join(root, pattern.strip().lstrip('/\\'))
+    if os.path.isdir(target):
+        target = os.path.join(target, '*')
+    paths = []
+    for p in sorted(glob.glob(target, recursive=True)):
+        real = os.path.realpath(p)
+        ext  = os.path.splitext(real)[1].lower()
+        if (os.path.commonpath([real, root]) == root and os.path.isfile(real)
+                and (ext in SOURCE_EXTS or ext in ARCHIVE_CODECS or ext == '.zip')):
+            paths.append(real)
+    return list(dict.fromkeys(paths))
+
+
+def expand_input(name, data, all_sheets=False):
+    """
+    The merge sources in one input — `data` being uploaded bytes or the path
+    of a server file: the file itself; one source per data file of a .zip;
+    the file inside a .gz / .zst; or — with `all_sheets` — one source per
+    worksheet of a workbook, sharing its bytes.
+    """
+    ext = os.path.splitext(name)[1].lower()
+    if ext == '.zip':
+        try:
+            return zip_members(name, data)
+        except zipfile.BadZipFile:
+            return [SourceFile(name, data)]  # let the probe report it
+    if ext in ARCHIVE_CODECS:
+        return [SourceFile(name[:-len(ext)], data, codec=ARCHIVE_CODECS[ext], name=name)]
+    if all_sheets and ext in EXCEL_EXTS:
+        try:
+            sheets = excel_sheet_names(name, data)
+        except Exception:
+            sheets = []  # unreadable workbook — let the probe report why
+        if len(sheets) > 1:
+            digest = SourceFile(name, data).digest
+            return [SourceFile(name, data, sheet=s, digest=digest) for s in sheets]
+    return [SourceFile(name, data)]
 
 
 def render_upload():
     st.markdown("""
     <div class="step-card">
         <h2>📁 STEP 1: Upload Files</h2>
-        <p>Upload 1–100 files. Supported formats: CSV, Excel, JSON, TXT</p>
+        <p>Upload 1–100 files. Supported formats: CSV, Excel, JSON/NDJSON, TXT, Parquet, Arrow/Feather — also inside .gz, .zst or .zip</p>
     </div>""", unsafe_allow_html=True)
 
-    files = st.file_uploader(
-        "Choose files",
-        type=['csv', 'xlsx', 'xls', 'txt', 'json'],
-        accept_multiple_files=True,
-        key="uploader"
+    server = False
+    if DATA_ROOT:
+        server = st.radio("Source", ["Upload files", "Server folder"], horizontal=True,
+                          key="ingest_mode") == "Server folder"
+
+    if server:
+        pattern = st.text_input(
+            f"Directory or glob pattern under `{DATA_ROOT}`", key="server_pattern",
+            placeholder="exports/2024-*/*.csv",
+            help="Files are read straight from the server's disk (memory-mapped) — nothing passes through "
+                 "the browser and there is no upload size limit. Use ** to include subfolders."
+        )
+        paths = resolve_server_paths(pattern) if pattern.strip() else []
+        if pattern.strip() and not paths:
+            st.warning("No supported files match that pattern.")
+        if len(paths) > MAX_SERVER_FILES:
+            st.warning(f"{len(paths):,} files match — only the first {MAX_SERVER_FILES} are used.")
+            paths = paths[:MAX_SERVER_FILES]
+    else:
+        files = st.file_uploader(
+            "Choose files",
+            type=[e[1:] for e in SOURCE_EXTS] + ['gz', 'zst', 'zip'],
+            accept_multiple_files=True,
+            key="uploader"
+        ) or []
+    all_sheets = st.checkbox(
+        "Merge every Excel sheet as its own file", key="excel_all_sheets",
+        help="By default only the first sheet of a workbook is read. "
+             "When ticked, each sheet becomes a separate source. Sheets are read in parallel "
+             "through python-calamine; the openpyxl fallback reads them one at a time."
     )
+    if server:
+        inputs = [(path_signature(p, all_sheets), os.path.relpath(p, os.path.realpath(DATA_ROOT)), lambda p=p: p)
+                  for p in paths]
+    else:
+        inputs = [(upload_signature(f, all_sheets), f.name, f.getvalue) for f in files]
 
-    if files:
-        # Only re-read if the file list has changed
-        current_names = [f.name for f in files]
-        cached_names  = [f.name for f in st.session_state.get('uploaded_files', [])]
+    if inputs:
+        # Only probe inputs that are new or changed; the rest keep their sources
+        groups  = st.session_state.upload_groups
+        current = [sig for sig, _, _ in inputs]
 
-        if current_names != cached_names or not st.session_state.file_dataframes:
-            dfs    = {}
-            errors = []
-            total  = len(files)
+        if current != list(groups):
+            fresh = {sig: expand_input(name, read(), all_sheets) for sig, name, read in inputs if sig not in groups}
+            todo  = [src for group in fresh.values() for src in group]
+            total = len(todo)
 
             progress_text = st.empty()
             progress_bar  = st.progress(0)
 
-            for i, f in enumerate(files):
-                progress_text.markdown(f"⏳ Reading **{i+1}/{total}** — `{f.name}`")
-                progress_bar.progress((i + 1) / total)
-                name, df = read_file_safe(f)
-                if df is not None:
-                    dfs[name] = df
-                else:
-                    errors.append(name)
+            def on_progress(done, total, name):
+                progress_text.markdown(f"⏳ Read **{done}/{total}** — `{name}`")
+                progress_bar.progress(done / total)
+
+            progress_text.markdown(f"⏳ Reading **{total}** file header(s) using up to {INGEST_WORKERS} workers…")
+            failed = probe_sources(todo, on_progress)
+            groups = {
+                sig: groups[sig] if sig in groups else [
+                    src for src in fresh[sig]
+                    if src.name not in failed and (src.sheet is None or len(src.columns))  # skip empty sheets
+                ]
+                for sig in current
+            }
 
             progress_bar.empty()
             progress_text.empty()
 
-            st.session_state.uploaded_files  = files
-            st.session_state.file_dataframes = dfs
+            st.session_state.upload_groups = groups
+            st.session_state.sources       = {src.name: src for group in groups.values() for src in group}
 
-            if errors:
-                st.warning("⚠️ Could not read: " + ", ".join(errors))
-        else:
-            dfs = st.session_state.file_dataframes
+            for name, err in failed.items():
+                st.warning(f"Could not read {name}: {err}")
+            if failed:
+                st.warning("⚠️ Could not read: " + ", ".join(failed))
 
-        if dfs:
-            st.success(f"✅ {len(dfs)} file(s) loaded!")
+        sources = st.session_state.sources
+        if sources:
+            st.success(f"✅ {len(sources)} file(s) loaded!")
 
-            with st.expander(f"📋 File Summary ({len(dfs)} files)", expanded=True):
+            with st.expander(f"📋 File Summary ({len(sources)} files)", expanded=True):
                 rows = []
-                for name, df in dfs.items():
+                for name, src in sources.items():
+                    n   = src.n_rows
+                    mem = src.memory
                     rows.append({
                         "File": name,
-                        "Rows": f"{len(df):,}",
-                        "Columns": len(df.columns),
-                        "Column Names": ", ".join(df.columns.tolist()[:8]) + ("…" if len(df.columns) > 8 else "")
+                        "Rows": "?" if n is None else f"{n:,}" if src.rows_exact else f"≈{n:,}",
+                        "Columns": len(src.columns),
+                        "Memory": "?" if mem is None else f"≈{format_bytes(mem[0])}",
+                        "Optimised": "?" if mem is None else f"≈{format_bytes(mem[1])}",
+                        "Column Names": ", ".join(map(str, src.columns[:8])) + ("…" if len(src.columns) > 8 else "")
                     })
                 st.dataframe(pd.DataFrame(rows), use_container_width=True, hide_index=True)
+                mems = [src.memory for src in sources.values() if src.memory]
+                if mems:
+                    before, after = map(sum, zip(*mems))
+                    st.caption(f"All files in memory: ≈{format_bytes(before)} as parsed, "
+                               f"≈{format_bytes(after)} with memory optimisation (Step 3).")
+                st.caption("Only headers and a sample are read here; "
+                           "the mapped columns are parsed in full when you merge.")
+
+            render_append(sources)
 
             if st.button("Next: Map Columns →", type="primary", use_container_width=True):
                 st.session_state.step = 2
@@ -362,6 +1586,39 @@ def render_upload():
                 st.rerun()
 
 
+def render_append(sources):
+    """Offer to append files uploaded since the last merge, instead of re-merging everything."""
+    state = st.session_state.merge_state
+    if st.session_state.merged_data is None or not state:
+        return
+    new = {name: src for name, src in sources.items() if name not in state['sources']}
+    if not new:
+        return
+    dedup   = state['dedup']
+    blocked = ("join merges" if state['join'] else
+               "Keep Last de-duplication" if dedup is not None and dedup.keep == 'last' else None)
+    st.info(f"➕ **{len(new)}** file(s) are not in the current merge of "
+            f"{len(state['sources'])} file(s). Append them with the same mapping and options, "
+            "or map everything again for a full re-merge.")
+    if blocked:
+        st.caption(f"Appending is not available for {blocked} — use a full re-merge.")
+    if st.button("➕ Append to merged data", use_container_width=True, disabled=bool(blocked)):
+        mapping = state['mapping']  # the merge's own — Step 2's may have changed since
+        for fname, src in new.items():
+            mapping, unmapped = extend_mapping(mapping, fname, src)
+            if unmapped:
+                st.toast(f"`{fname}`: no target column for " + ", ".join(f"`{c}`" for c in unmapped))
+        state['mapping'] = mapping
+        bar    = st.progress(0)
+        failed = append_to_merge(new, on_progress=lambda done, total: bar.progress(done / max(total, 1)))
+        bar.empty()
+        for name, err in failed.items():
+            st.error(f"Could not read {name}: {err}")
+        if not failed:
+            st.session_state.step = 4
+            st.rerun()
+
+
 # ─────────────────────────────────────────
 # STEP 2 – COLUMN MAPPING
 # ─────────────────────────────────────────
@@ -388,7 +1645,7 @@ def normalize_col(col: str) -> str:
     return s
 
 
-def build_auto_mapping(dfs):
+def build_auto_mapping(sources):
     """
     Build automatic column mapping.
     Columns are matched after:
@@ -399,8 +1656,8 @@ def build_auto_mapping(dfs):
     contains that column.
     """
     all_cols = {}
-    for fname, df in dfs.items():
-        for col in df.columns:
+    for fname, src in sources.items():
+        for col in src.columns:
             norm = normalize_col(col)
             if norm not in all_cols:
                 # Use the original column name from the first file as the canonical label
@@ -410,6 +1667,23 @@ def build_auto_mapping(dfs):
     return all_cols  # {norm_name: {canonical, norm, files:{fname:actual_col}}}
 
 
+def extend_mapping(mapping, fname, src):
+    """
+    `mapping` with `fname` added: each target column takes the column of
+    `src` whose normalized name matches the target or a column already
+    mapped onto it. Returns (mapping, columns of `src` left unmapped).
+    """
+    by_norm = {normalize_col(c): c for c in reversed(list(src.columns))}  # first match wins
+    used    = set()
+    out     = {}
+    for target, cols in mapping.items():
+        names = [target] + [c for c in cols.values() if c]
+        match = next((by_norm[n] for n in map(normalize_col, names) if n in by_norm), None)
+        out[target] = {**cols, fname: match}
+        used.add(match)
+    return out, [c for c in src.columns if c not in used]
+
+
 def render_column_mapping():
     st.markdown("""
     <div class="step-card">
@@ -417,15 +1691,15 @@ def render_column_mapping():
         <p>Review automatic mapping. Manually adjust, skip, or remap columns as needed.</p>
     </div>""", unsafe_allow_html=True)
 
-    dfs    = st.session_state.file_dataframes
-    fnames = list(dfs.keys())
+    sources = st.session_state.sources
+    fnames  = list(sources.keys())
 
-    if not dfs:
+    if not sources:
         st.error("No files loaded.")
         back_button(1)
         return
 
-    auto         = build_auto_mapping(dfs)
+    auto         = build_auto_mapping(sources)
     full_cols    = [n for n, v in auto.items() if len(v['files']) == len(fnames)]
     partial_cols = [n for n, v in auto.items() if 0 < len(v['files']) < len(fnames)]
 
@@ -512,7 +1786,7 @@ def render_column_mapping():
                 with st.expander(f"Remap for **{canon}** ({len(missing)} missing files)"):
                     for fn in missing:
                         mapped_cols = {v2['canonical'] for v2 in auto.values() if fn in v2['files']}
-                        other_cols  = [c for c in dfs[fn].columns if c not in mapped_cols]
+                        other_cols  = [c for c in sources[fn].columns if c not in mapped_cols]
                         if other_cols:
                             st.selectbox(
                                 f"`{fn}` → map from:",
@@ -562,35 +1836,898 @@ def render_column_mapping():
 
 
 # ─────────────────────────────────────────
-# STEP 3 – CONFIGURE & MERGE
+# COLUMN PROFILE
 # ─────────────────────────────────────────
-def apply_mapping_and_merge(dfs, mapping, add_source, handle_dupes):
-    """Apply column mapping and concatenate all DataFrames."""
-    target_cols = list(mapping.keys())
-    frames = []
-
-    for fname, df in dfs.items():
-        row_df = pd.DataFrame(index=range(len(df)))
-        for tcol in target_cols:
-            scol = mapping[tcol].get(fname)
-            if scol and scol in df.columns:
-                row_df[tcol] = df[scol].values
-            else:
-                row_df[tcol] = np.nan
-        if add_source:
-            row_df['_source_file'] = fname
-        frames.append(row_df)
+PROFILE_TOP_K     = 100    # distinct values up to which a column gets a multiselect filter
+PROFILE_TRACK_MAX = 1_000  # distinct values counted exactly before falling back to heavy hitters
+HLL_PRECISION     = 12     # HyperLogLog with 2**12 registers — ~1.6% standard error
+
+
+def common_dtype(kinds):
+    """The dtype pd.concat gives pieces of these dtypes (same → same, numeric → float64, else object)."""
+    if all(k == kinds[0] for k in kinds):
+        return kinds[0]
+    if all(pd.api.types.is_numeric_dtype(k) for k in kinds):
+        return np.dtype('float64')
+    return np.dtype('object')
+
+
+def hll_registers(values):
+    """HyperLogLog registers of the non-null `values` (a Series)."""
+    p     = HLL_PRECISION
+    regs  = np.zeros(1 << p, dtype=np.uint8)
+    h     = pd.util.hash_pandas_object(values.dropna(), index=False).to_numpy()
+    if not len(h):
+        return regs
+    idx   = (h >> np.uint64(64 - p)).astype(np.int64)
+    rest  = (h & np.uint64((1 << (64 - p)) - 1)).astype(np.float64)  # < 2**52, exact in float64
+    bits  = np.where(rest > 0, np.floor(np.log2(np.maximum(rest, 1))) + 1, 0)
+    rank  = (64 - p - bits + 1).astype(np.uint8)
+    np.maximum.at(regs, idx, rank)
+    return regs
+
+
+def hll_estimate(regs):
+    m     = len(regs)
+    alpha = 0.7213 / (1 + 1.079 / m)
+    raw   = alpha * m * m / np.sum(np.exp2(-regs.astype(np.float64)))
+    zeros = int(np.count_nonzero(regs == 0))
+    if raw <= 2.5 * m and zeros:
+        return int(round(m * np.log(m / zeros)))  # linear counting for small cardinalities
+    return int(round(raw))
+
+
+class ColumnProfile:
+    """
+    Per-column summary of the merged data, computed once in the merge step
+    and kept next to `merged_data`: dtype, null count, min/max, distinct
+    count and the most frequent values. Filter widgets and the sidebar read
+    it instead of rescanning the data on every rerun.
+
+    Every statistic is mergeable, so the profile is built chunk by chunk
+    (update) — the streaming engine profiles partitions as it writes them.
+    Distinct values are counted exactly up to PROFILE_TRACK_MAX; beyond
+    that the count comes from a HyperLogLog sketch and only the heaviest
+    values are kept.
+    """
 
-    merged = pd.concat(frames, ignore_index=True)
+    def __init__(self):
+        self._cols = {}
+
+    def checkpoint(self):
+        """Opaque copy of the statistics so far, for rollback()."""
+        return copy.deepcopy(self._cols)
+
+    def rollback(self, mark):
+        self._cols = copy.deepcopy(mark)
+
+    def update(self, frame):
+        for col in frame.columns:
+            s = frame[col]
+            c = self._cols.get(col)
+            if c is None:
+                c = self._cols[col] = {
+                    'kinds': [], 'count': 0, 'nulls': 0, 'min': None, 'max': None,
+                    'hll': np.zeros(1 << HLL_PRECISION, dtype=np.uint8),
+                    'counts': pd.Series(dtype='int64'), 'overflow': False,
+                }
+            if s.dtype not in c['kinds']:
+                c['kinds'].append(s.dtype)
+            c['count'] += len(s)
+            c['nulls'] += int(s.isna().sum())
+            if pd.api.types.is_numeric_dtype(s.dtype) and s.notna().any():
+                mn, mx   = float(s.min()), float(s.max())
+                c['min'] = mn if c['min'] is None else min(c['min'], mn)
+                c['max'] = mx if c['max'] is None else max(c['max'], mx)
+            np.maximum(c['hll'], hll_registers(s), out=c['hll'])
+            if c['overflow']:  # high-cardinality column: only this chunk's heaviest values can matter
+                vc = s.value_counts(dropna=True).head(PROFILE_TRACK_MAX)
+            else:
+                vc = s.value_counts(sort=False, dropna=True)
+            vc = vc[vc > 0]  # unused categories of a categorical
+            if len(c['counts']):
+                vc = pd.concat([c['counts'], vc]).groupby(level=0, sort=False).sum()
+            if len(vc) > PROFILE_TRACK_MAX:
+                vc = vc.nlargest(PROFILE_TRACK_MAX)
+                c['overflow'] = True
+            c['counts'] = vc
+
+    def __contains__(self, col):
+        return col in self._cols
+
+    def __getitem__(self, col):
+        c     = self._cols[col]
+        dtype = common_dtype(c['kinds'])
+        exact = not c['overflow']
+        return {
+            'dtype':    dtype,
+            'numeric':  pd.api.types.is_numeric_dtype(dtype),
+            'count':    c['count'],
+            'nulls':    c['nulls'],
+            'min':      c['min'],
+            'max':      c['max'],
+            'distinct': len(c['counts']) if exact else  # the HLL estimate, capped at the non-null rows
+                        min(max(hll_estimate(c['hll']), len(c['counts'])), c['count'] - c['nulls']),
+            'exact':    exact,
+            'values':   c['counts'].index.tolist() if exact else None,  # first-seen order
+            'top':      c['counts'].nlargest(PROFILE_TOP_K),
+        }
+
+    @property
+    def columns(self):
+        return list(self._cols)
+
+    def numeric_columns(self):
+        return [c for c in self._cols if self[c]['numeric']]
+
+    def other_columns(self):
+        return [c for c in self._cols if not self[c]['numeric']]
+
+    def summary(self):
+        """One row per column, for display."""
+        rows = []
+        for col in self._cols:
+            p = self[col]
+            rows.append({
+                "Column":   col,
+                "Type":     str(p['dtype']),
+                "Nulls":    p['nulls'],
+                "Distinct": f"{p['distinct']:,}" if p['exact'] else f"≈{p['distinct']:,}",  # one type for Arrow
+                "Min":      p['min'],
+                "Max":      p['max'],
+                "Top value": str(p['top'].index[0]) if len(p['top']) else None,
+            })
+        return pd.DataFrame(rows)
+
+
+def get_column_profile(data):
+    """Profile of the current merged data — normally computed at merge time, built here as a fallback."""
+    profile = st.session_state.get('column_profile')
+    if profile is None and data is not None:
+        profile = ColumnProfile()
+        for part in (data.iter_frames() if is_store(data) else [data]):
+            profile.update(part)
+        st.session_state.column_profile = profile
+    return profile
 
-    if handle_dupes == "Remove Exact Duplicates":
-        merged = merged.drop_duplicates()
-    elif handle_dupes == "Keep First":
-        merged = merged.drop_duplicates(keep='first')
-    elif handle_dupes == "Keep Last":
-        merged = merged.drop_duplicates(keep='last')
 
-    return merged
+# ─────────────────────────────────────────
+# STEP 3 – CONFIGURE & MERGE
+# ─────────────────────────────────────────
+STORE_DIR         = os.environ.get("FMP_STORE_DIR",
+                                   os.path.join(tempfile.gettempdir(), "file_merger_pro_store"))
+STORE_MAX_AGE     = float(os.environ.get("FMP_STORE_MAX_AGE_H", "24")) * 3600  # stale partitions swept at startup
+MERGE_CHUNK_ROWS  = 250_000    # rows per partition in the streaming engine
+STREAMING_DEFAULT = 2_000_000  # total input rows above which streaming is pre-selected
+JOIN_TYPES        = {"Left": "left", "Inner": "inner", "Outer": "outer"}
+JOIN_PARTITIONS   = INGEST_WORKERS  # hash partitions joined in parallel
+JOIN_SKEW_SHARE   = 0.1        # a key holding more than this share of a file's rows is reported as skew ...
+JOIN_SKEW_ROWS    = 10_000     # ... once it holds at least this many rows
+
+
+class MergedStore:
+    """
+    Merged dataset kept on local disk as a directory of Parquet partitions.
+    Only metadata lives in session state; data is read back lazily — by
+    column (Parquet projection) and by row (partition offsets) — so the
+    analysis and download steps never need the whole merge in memory.
+    Duck-types the bits of the DataFrame API the app uses: len(), .columns,
+    .dtypes and .head().
+    """
+
+    def __init__(self, root=STORE_DIR):
+        os.makedirs(root, exist_ok=True)
+        self.path   = tempfile.mkdtemp(prefix="merge_", dir=root)
+        self.parts  = []   # [(parquet path, n_rows)]
+        self._dtypes = {}  # {column: [dtype per partition]}
+        self._cols   = []
+        # Partitions go with the store: on close(), when a session ends and drops it, or at exit
+        self._remove = weakref.finalize(self, shutil.rmtree, self.path, ignore_errors=True)
+
+    # ── writing ──
+    def append(self, frame):
+        """Write one partition. Column names are stored as strings (a Parquet requirement)."""
+        if frame.empty:
+            return
+        frame = frame.rename(columns=str)
+        path  = os.path.join(self.path, f"part-{len(self.parts):05d}.parquet")
+        try:
+            frame.to_parquet(path, index=False)
+        except (pa.ArrowException, TypeError, ValueError):
+            # Mixed-type object columns (e.g. numbers and text from Excel) — store as text
+            mixed = [c for c in frame.columns if frame[c].dtype == object]
+            frame = frame.astype({c: "string" for c in mixed})
+            frame.to_parquet(path, index=False)
+        self.parts.append((path, len(frame)))
+        for c in frame.columns:
+            if c not in self._dtypes:
+                self._cols.append(c)
+            self._dtypes.setdefault(c, []).append(frame[c].dtype)
+
+    def checkpoint(self):
+        """Opaque marker of the partitions written so far, for rollback()."""
+        return len(self.parts), {c: len(d) for c, d in self._dtypes.items()}
+
+    def rollback(self, mark):
+        """Delete the partitions appended since checkpoint() returned `mark`."""
+        n, counts = mark
+        for path, _ in self.parts[n:]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        del self.parts[n:]
+        self._dtypes = {c: d[:counts[c]] for c, d in self._dtypes.items() if c in counts}
+        self._cols   = [c for c in self._cols if c in counts]
+
+    def close(self):
+        self._remove()
+
+    def arrow_schema(self):
+        """
+        One Arrow schema every partition can be cast to (ints widen to floats,
+        etc.). A column whose partitions have no common type — text in one,
+        all-blank doubles in another — is exported as text.
+        """
+        import pyarrow.parquet as pq
+        schemas = [pq.read_schema(path) for path, _ in self.parts]
+        fields  = []
+        for c in self._cols:
+            types = [s.field(c).type for s in schemas if c in s.names] or [pa.null()]
+            try:
+                fields.append(pa.unify_schemas([pa.schema([(c, t)]) for t in types],
+                                               promote_options='permissive').field(c))
+            except (pa.ArrowTypeError, pa.ArrowInvalid, pa.ArrowNotImplementedError):
+                fields.append(pa.field(c, pa.large_string()))
+        return pa.schema(fields)
+
+    # ── metadata ──
+    def __len__(self):
+        return sum(n for _, n in self.parts)
+
+    @property
+    def columns(self):
+        return pd.Index(self._cols)
+
+    @property
+    def dtypes(self):
+        """Result dtype per column, as pd.concat of all partitions would give."""
+        return pd.Series({c: common_dtype(self._dtypes[c]) for c in self._cols}, dtype=object)
+
+    # ── reading ──
+    def iter_frames(self, columns=None, rows=None):
+        """
+        Yield the dataset partition by partition, projected to `columns`.
+        `rows` (sorted positional indices) restricts output to those rows;
+        partitions without a selected row are not read at all.
+        """
+        offset = 0
+        for path, n in self.parts:
+            lo, hi = offset, offset + n
+            offset = hi
+            if rows is None:
+                yield pd.read_parquet(path, columns=columns)
+                continue
+            a, b = np.searchsorted(rows, [lo, hi])
+            if a == b:
+                continue
+            yield pd.read_parquet(path, columns=columns).take(rows[a:b] - lo)
+
+    def read(self, columns=None, rows=None):
+        frames = list(self.iter_frames(columns, rows))
+        if not frames:
+            cols = self._cols if columns is None else columns
+            return pd.DataFrame({c: pd.Series(dtype=self.dtypes[c]) for c in cols})
+        return pd.concat(frames, ignore_index=True)
+
+    def head(self, n=5):
+        return self.read(rows=np.arange(min(n, len(self))))
+
+
+@st.cache_resource(show_spinner=False)
+def sweep_stale_stores(root=STORE_DIR, max_age=STORE_MAX_AGE):
+    """
+    Once per server process: remove store directories untouched for
+    `max_age` seconds — left behind by a server that was killed before its
+    sessions could clean up.
+    """
+    if not os.path.isdir(root):
+        return
+    cutoff = time.time() - max_age
+    for entry in os.scandir(root):
+        if entry.name.startswith("merge_") and entry.is_dir() and entry.stat().st_mtime < cutoff:
+            shutil.rmtree(entry.path, ignore_errors=True)
+
+
+def is_store(data):
+    """
+    True for a MergedStore. Duck-typed on purpose: Streamlit re-executes the
+    script on every rerun, so a store created in an earlier run is an instance
+    of an earlier (distinct) MergedStore class and isinstance() would miss it.
+    """
+    return hasattr(data, 'iter_frames')
+
+
+def load_columns(data, columns=None, rows=None):
+    """
+    Materialise `columns` (all when None) for positional `rows` (all when None)
+    of the merged data — an in-memory DataFrame or an on-disk MergedStore.
+    """
+    if is_store(data):
+        return data.read(columns, rows)
+    df = data if columns is None else data[columns]
+    return df if rows is None else df.take(rows)
+
+
+def null_dtype(dtype):
+    """
+    dtype for the blanks of a column that is missing from a file: the nullable
+    counterpart of the dtype the column has elsewhere, so filling blanks never
+    turns integers into floats or text into floats.
+    """
+    if pd.api.types.is_bool_dtype(dtype):
+        return pd.BooleanDtype()
+    if pd.api.types.is_integer_dtype(dtype) and not isinstance(dtype, pd.api.extensions.ExtensionDtype):
+        return pd.Int64Dtype()
+    if isinstance(dtype, pd.CategoricalDtype):
+        return np.dtype('object')
+    return dtype
+
+
+def merge_null_dtypes(dfs, mapping, target_cols):
+    """
+    {target column: dtype of its blanks}, taken from the first file that has
+    the column. `dfs` may hold frames or probed sources (sample dtypes).
+    """
+    out = {}
+    for tcol in target_cols:
+        out[tcol] = np.dtype('float64')  # column present nowhere — plain NaN, as before
+        for fname, scol in mapping[tcol].items():
+            df = dfs.get(fname)
+            if df is not None and scol and scol in df.columns:
+                out[tcol] = null_dtype(df.dtypes[scol])
+                break
+    return out
+
+
+def mapped_source_columns(sources, mapping):
+    """{filename: the source columns the mapping uses} — all a merge-time parse has to read."""
+    out = {}
+    for fname, src in sources.items():
+        used = {cols.get(fname) for cols in mapping.values()}
+        keep = [c for c in src.columns if c in used]
+        out[fname] = keep or list(src.columns[:1])  # one column still carries the file's row count
+    return out
+
+
+def map_frame(df, fname, mapping, target_cols, add_source, null_dtypes=None):
+    """
+    Project one source frame onto the target columns of the mapping.
+    A select-and-rename: mapped columns are passed through as zero-copy
+    views of the source arrays, blanks are typed all-null arrays built once
+    per dtype, and nothing is inserted column by column.
+    """
+    n      = len(df)
+    index  = pd.RangeIndex(n)
+    blanks = {}
+    cols   = {}
+    for tcol in target_cols:
+        scol = mapping[tcol].get(fname)
+        if scol and scol in df.columns:
+            cols[tcol] = df[scol].array
+        else:
+            dt = (null_dtypes or {}).get(tcol, np.dtype('float64'))
+            if dt not in blanks:
+                blanks[dt] = pd.Series(index=index, dtype=dt).array
+            cols[tcol] = blanks[dt]
+    if add_source:
+        cols['_source_file'] = np.full(n, fname, dtype=object)
+    return pd.DataFrame(cols, index=index, columns=list(cols), copy=False)
+
+
+def _numeric_hashes(s):
+    """
+    Per-value hash of a numeric column. Integers hash as int64 — exactly,
+    however large — and so does a float that is whole and fits in int64,
+    so 1 (int) in one file and 1.0 (float) in another count as the same
+    value. Other floats (fractions, inf, NaN, nulls) hash as float64.
+    """
+    if pd.api.types.is_integer_dtype(s.dtype) or pd.api.types.is_bool_dtype(s.dtype):
+        ints  = s.to_numpy(dtype='int64', na_value=0)
+        whole = ~s.isna().to_numpy()
+        flts  = np.full(len(s), np.nan)
+    else:
+        flts = s.to_numpy(dtype='float64', na_value=np.nan)
+        with np.errstate(invalid='ignore'):
+            whole = (flts == np.trunc(flts)) & (np.abs(flts) < 2.0 ** 63)
+        ints = np.where(whole, flts, 0).astype(np.int64)
+    return np.where(whole, pd.util.hash_array(ints), pd.util.hash_array(flts))
+
+
+def row_hashes(frame, columns):
+    """
+    64-bit hash of every row over `columns`. Numbers are compared by value
+    across dtypes without rounding distinct integers together — see
+    _numeric_hashes().
+    """
+    cols = {}
+    for col in columns:
+        s = frame[col]
+        if pd.api.types.is_numeric_dtype(s.dtype):
+            s = pd.Series(_numeric_hashes(s), copy=False)
+        cols[col] = s.reset_index(drop=True)
+    return pd.util.hash_pandas_object(pd.DataFrame(cols), index=False).to_numpy()
+
+
+class RowDeduper:
+    """
+    Drops duplicate rows while a merge streams past, one mapped chunk at a
+    time, remembering only a 64-bit hash per distinct row — never the rows.
+    Rows are compared on `subset` (all target columns when None;
+    `_source_file` is never part of the key).
+
+    keep='first': hashes live in sorted runs merged like an LSM tree, so a
+    lookup is a few binary searches and inserts stay amortised O(log n).
+    keep='last' has to know the future: observe() every chunk in a first
+    pass, then filter() the same chunks in the same order.
+
+    `dropped` counts removed rows per source file.
+    """
+
+    def __init__(self, keep='first', subset=None):
+        self.keep    = keep
+        self.subset  = list(subset) if subset else None
+        self.dropped = {}
+        self._runs   = []    # disjoint sorted uint64 arrays, sizes roughly halving
+        self._hashes = []    # keep='last': hashes of the first pass
+        self._last   = None  # keep='last': mask over all rows, built on the first filter()
+        self._pos    = 0
+
+    @property
+    def removed(self):
+        return sum(self.dropped.values())
+
+    def checkpoint(self):
+        """Opaque marker of the rows seen so far (keep='first'), for rollback(). Runs are never modified in place."""
+        return list(self._runs), dict(self.dropped)
+
+    def rollback(self, mark):
+        self._runs, self.dropped = list(mark[0]), dict(mark[1])
+
+    def hashes(self, frame):
+        return row_hashes(frame, self.subset or [c for c in frame.columns if c != '_source_file'])
+
+    def _seen(self, h):
+        mask = np.zeros(len(h), dtype=bool)
+        for run in self._runs:
+            pos   = np.minimum(np.searchsorted(run, h), len(run) - 1)
+            mask |= run[pos] == h
+        return mask
+
+    def _add(self, h):
+        self._runs.append(np.sort(h))
+        while len(self._runs) > 1 and len(self._runs[-2]) <= 2 * len(self._runs[-1]):
+            last = self._runs.pop()
+            self._runs[-1] = np.sort(np.concatenate([self._runs[-1], last]), kind='stable')
+
+    def observe(self, frame):
+        """First pass of keep='last'."""
+        self._hashes.append(self.hashes(frame))
+
+    def filter(self, frame, fname):
+        """`frame` without its duplicate rows, counted against `fname`."""
+        if self.keep == 'last':
+            if self._last is None:
+                h = np.concatenate(self._hashes) if self._hashes else np.empty(0, dtype=np.uint64)
+                _, idx = np.unique(h[::-1], return_index=True)
+                self._last = np.zeros(len(h), dtype=bool)
+                self._last[len(h) - 1 - idx] = True
+                self._hashes = None
+            keep = self._last[self._pos:self._pos + len(frame)]
+            self._pos += len(frame)
+        else:
+            h = self.hashes(frame)
+            _, first = np.unique(h, return_index=True)
+            keep = np.zeros(len(h), dtype=bool)
+            keep[first] = ~self._seen(h[first])  # first in this chunk and unseen before
+            if keep.any():
+                self._add(h[keep])
+        n = len(frame) - int(keep.sum())
+        if not n:
+            return frame
+        self.dropped[fname] = self.dropped.get(fname, 0) + n
+        return frame[keep].reset_index(drop=True)
+
+
+def make_deduper(handle_dupes, subset=None):
+    """The RowDeduper for a "Duplicate handling" choice, None for Keep All."""
+    if handle_dupes == "Remove Exact Duplicates":
+        return RowDeduper('first')
+    if handle_dupes == "Keep First":
+        return RowDeduper('first', subset)
+    if handle_dupes == "Keep Last":
+        return RowDeduper('last', subset)
+    return None
+
+
+def own_targets(df, fname, mapping):
+    """Target columns that `fname` maps onto one of its own columns — what it contributes to a join."""
+    return [t for t, cols in mapping.items() if cols.get(fname) and cols[fname] in df.columns]
+
+
+def key_counts(frame, keys):
+    """(sorted distinct key hashes, rows per key, index of each key's first row)."""
+    u, first, c = np.unique(row_hashes(frame, keys), return_index=True, return_counts=True)
+    return u, c, first
+
+
+def plan_join(key_frames, base, keys, how):
+    """
+    Row counts of joining every other file onto `base`, worked out from key
+    hashes alone — before anything is joined. `key_frames` holds just the
+    mapped key columns of each file; each join step casts them with
+    align_keys() first, as the join does. Returns {'rows', 'report',
+    'warnings'}: the final row count, one report row per file and notes on
+    duplicate keys (which multiply rows) and skewed keys (which load one
+    partition).
+    """
+    u, c, first = key_counts(key_frames[base], keys)
+    acc      = key_frames[base].iloc[first].reset_index(drop=True)  # distinct joined keys, in `u` order
+    rows     = int(c.sum())
+    report   = []
+    warnings = []
+
+    def heaviest(counts, fname):
+        share = counts.max() / counts.sum() if len(counts) else 0.0
+        if share > JOIN_SKEW_SHARE and counts.max() >= JOIN_SKEW_ROWS:
+            warnings.append(f"Skewed key in `{fname}`: one key value holds {100 * share:.0f}% of its rows.")
+        return f"{100 * share:.1f}%"
+
+    report.append({"File": base, "Role": "base", "Rows": rows, "Distinct keys": len(u),
+                   "Duplicate keys": int((c > 1).sum()), "Heaviest key": heaviest(c, base),
+                   "Matched rows": None, "Rows after": rows})
+    for fname, kf in key_frames.items():
+        if fname == base:
+            continue
+        aligned, kf = align_keys(acc, kf, keys)
+        if aligned is not acc:  # key dtypes changed — rehash, folding keys that now coincide
+            u, first, inv = np.unique(row_hashes(aligned, keys), return_index=True, return_inverse=True)
+            c   = np.bincount(inv.ravel(), weights=c, minlength=len(u)).astype(np.int64)
+            acc = aligned.iloc[first].reset_index(drop=True)
+        ru, rc, rfirst = key_counts(kf, keys)
+        common, li, ri = np.intersect1d(u, ru, assume_unique=True, return_indices=True)
+        matched = int(c[li].sum())
+        fanned  = c[li] * rc[ri]
+        if how == 'inner':
+            u, c, acc = common, fanned, acc.iloc[li].reset_index(drop=True)
+        else:
+            c = c.copy()
+            c[li] = fanned
+            if how == 'outer':
+                extra = ~np.isin(ru, common, assume_unique=True)
+                u, c  = np.concatenate([u, ru[extra]]), np.concatenate([c, rc[extra]])
+                acc   = pd.concat([acc, kf[keys].iloc[rfirst[extra]]], ignore_index=True)
+                order = np.argsort(u, kind='stable')
+                u, c  = u[order], c[order]
+                acc   = acc.iloc[order].reset_index(drop=True)
+        dupes = int((rc > 1).sum())
+        if dupes:
+            warnings.append(f"`{fname}` has {dupes:,} duplicate key value(s) — every matching row is repeated once per duplicate.")
+        after = int(c.sum())
+        report.append({"File": fname, "Role": "lookup", "Rows": int(rc.sum()), "Distinct keys": len(ru),
+                       "Duplicate keys": dupes, "Heaviest key": heaviest(rc, fname),
+                       "Matched rows": matched, "Rows after": after})
+        rows = after
+    return {'rows': rows, 'report': pd.DataFrame(report), 'warnings': warnings}
+
+
+def align_keys(left, right, keys):
+    """
+    Give the key columns of both sides one dtype: Int64 when both are
+    integers (exact, however large), float64 when both are numeric, else
+    text. Sides that already agree are returned as they are.
+    """
+    for k in keys:
+        lt, rt = left[k].dtype, right[k].dtype
+        if lt == rt:
+            continue
+        if pd.api.types.is_integer_dtype(lt) and pd.api.types.is_integer_dtype(rt):
+            dt = 'Int64'
+        elif pd.api.types.is_numeric_dtype(lt) and pd.api.types.is_numeric_dtype(rt):
+            dt = 'float64'
+        else:
+            dt = 'string'
+        left  = left.astype({k: dt})
+        right = right.astype({k: dt})
+    return left, right
+
+
+def hash_join(left, right, keys, how, partitions=JOIN_PARTITIONS):
+    """
+    left.merge(right) as a partitioned hash join: rows of both sides are split
+    by key hash, and partitions are joined concurrently (pandas releases the
+    GIL in its hash tables). Left rows keep their order; an outer join's
+    unmatched right rows come last.
+    """
+    left, right = align_keys(left, right, keys)
+    left = left.assign(__row__=np.arange(len(left)))
+    if partitions > 1 and len(left) + len(right) >= 2 * MERGE_CHUNK_ROWS:
+        def split(frame):
+            part   = (row_hashes(frame, keys) % np.uint64(partitions)).astype(np.int64)
+            order  = np.argsort(part, kind='stable')
+            bounds = np.cumsum(np.bincount(part, minlength=partitions))[:-1]
+            return [frame.take(rows) for rows in np.split(order, bounds)]
+
+        pairs = zip(split(left), split(right))
+        with ThreadPoolExecutor(max_workers=partitions) as ex:
+            parts = list(ex.map(lambda lr: lr[0].merge(lr[1], on=keys, how=how), pairs))
+        out = pd.concat(parts, ignore_index=True)
+        out = out.sort_values('__row__', kind='stable', na_position='last')
+    else:
+        out = left.merge(right, on=keys, how=how)
+    return out.drop(columns='__row__').reset_index(drop=True)
+
+
+def join_frames(base, lookups, keys, how):
+    """
+    Join each lookup frame onto `base` in turn. A non-key column that is
+    already taken gets its lookup's name appended (`price_rates`).
+    """
+    out = base
+    for fname, frame in lookups.items():
+        stem = os.path.splitext(os.path.basename(fname))[0]
+        frame = frame.rename(columns={c: f"{c}_{stem}" for c in frame.columns
+                                      if c in out.columns and c not in keys})
+        out = hash_join(out, frame, keys, how)
+    return out
+
+
+def apply_mapping_and_join(dfs, mapping, keys, how, base, dedup=None):
+    """
+    Join variant of apply_mapping_and_merge: every file contributes its own
+    mapped columns, joined onto `base` on `keys`. Duplicates of the joined
+    rows are counted against the base file.
+    """
+    frames = {fname: map_frame(df, fname, mapping, own_targets(df, fname, mapping), False) for fname, df in dfs.items()}
+    merged = join_frames(frames.pop(base), frames, keys, how)
+    if dedup is not None:
+        if dedup.keep == 'last':
+            dedup.observe(merged)
+        merged = dedup.filter(merged, base)
+    return merged
+
+
+def apply_mapping_and_merge(dfs, mapping, add_source, dedup=None):
+    """
+    Apply column mapping and concatenate all DataFrames. With a RowDeduper,
+    duplicates are dropped file by file before the concat, so they never
+    reach the merged frame.
+    """
+    target_cols = list(mapping.keys())
+    null_dtypes = merge_null_dtypes(dfs, mapping, target_cols)
+    frames = [map_frame(df, fname, mapping, target_cols, add_source, null_dtypes) for fname, df in dfs.items()]
+
+    if dedup is not None:
+        if dedup.keep == 'last':
+            for frame in frames:
+                dedup.observe(frame)
+        frames = [dedup.filter(frame, fname) for frame, fname in zip(frames, dfs)]
+
+    return pd.concat(frames, ignore_index=True)
+
+
+def stream_mapping_and_merge(sources, mapping, add_source, chunk_rows=MERGE_CHUNK_ROWS, on_progress=None,
+                             dedup=None, join=None):
+    """
+    Out-of-core variant of apply_mapping_and_merge: read each source chunk
+    by chunk (mapped columns only), map it and append it to a MergedStore on
+    disk. Peak extra memory is one chunk, independent of the total number of
+    rows — plus 8 bytes per distinct row with a RowDeduper (keep='last'
+    reads the sources twice). Returns (store, ColumnProfile) — chunks are
+    profiled on their way to disk.
+
+    With `join` = (keys, how, base) the lookup files are loaded into memory
+    and only the base file is streamed, each chunk joined on its way through
+    (left / inner joins only — an outer join needs every row of the base).
+    """
+    target_cols = list(mapping.keys())
+    null_dtypes = merge_null_dtypes(sources, mapping, target_cols)
+    columns  = mapped_source_columns(sources, mapping)
+    profile  = ColumnProfile()
+    passes   = 2 if dedup is not None and dedup.keep == 'last' else 1
+    streamed = {join[2]: sources[join[2]]} if join else sources
+    total    = passes * sum(src.n_rows or 0 for src in streamed.values())
+    done     = 0
+    lookups  = {}
+    if join:
+        keys, how, base = join
+        if how == 'outer':
+            raise ValueError("Outer joins need the in-memory engine.")
+        for fname, src in sources.items():
+            if fname != base:
+                df = src.load(columns[fname])
+                lookups[fname] = map_frame(df, fname, mapping, own_targets(df, fname, mapping), False)
+
+    def mapped_chunks():
+        nonlocal done
+        for fname, src in streamed.items():
+            for chunk in src.iter_chunks(columns[fname], chunk_rows):
+                if join:
+                    mapped = map_frame(chunk, fname, mapping, own_targets(chunk, fname, mapping), False)
+                    yield fname, join_frames(mapped, lookups, keys, how)
+                else:
+                    yield fname, map_frame(chunk, fname, mapping, target_cols, add_source, null_dtypes)
+                done += len(chunk)
+                if on_progress:
+                    on_progress(done, max(total, done))
+
+    store = MergedStore()
+    try:
+        if passes == 2:
+            for _, mapped in mapped_chunks():
+                dedup.observe(mapped)
+        for fname, mapped in mapped_chunks():
+            if dedup is not None:
+                mapped = dedup.filter(mapped, fname)
+            profile.update(mapped)
+            store.append(mapped)
+    except BaseException:
+        store.close()
+        raise
+    return store, profile
+
+
+def set_merged_data(data, profile=None, memory=None, state=None):
+    """
+    Replace the merged result (and its profile, (before, after) optimisation
+    byte counts and merge state), removing the on-disk partitions of the
+    previous one.
+    """
+    old = st.session_state.get('merged_data')
+    if is_store(old) and old is not data:
+        old.close()
+    st.session_state.merged_data    = data
+    st.session_state.column_profile = profile
+    st.session_state.merged_memory  = memory
+    st.session_state.merge_state    = state
+    st.session_state.result_cache   = None
+    st.session_state.workbook_sheets = {}
+    st.session_state.merged_token   = None if data is None else uuid.uuid4().hex
+
+
+def concat_merged(old, new):
+    """
+    pd.concat of the merged frame and appended rows that keeps categorical
+    columns categorical (plain concat turns differing categories into objects).
+    """
+    cols = {}
+    for col in old.columns:
+        a, b = old[col], new[col]
+        if isinstance(a.dtype, pd.CategoricalDtype):
+            try:
+                cols[col] = pd.api.types.union_categoricals([a.array, pd.Categorical(b)])
+                continue
+            except TypeError:  # categories of a different type — fall back to a plain concat
+                pass
+        cols[col] = pd.concat([a, b], ignore_index=True)
+    return pd.DataFrame(cols, index=pd.RangeIndex(len(old) + len(new)), columns=old.columns, copy=False)
+
+
+def append_to_merge(new, on_progress=None):
+    """
+    Map the `new` sources with the merge's own column mapping (saved in
+    `merge_state`, extended by render_append()) and append them to the
+    merged data — in place for an on-disk store, by one concat in memory.
+    Nothing already merged is re-read: the dedup state (`merge_state`)
+    drops rows seen in earlier files, the column profile is updated with the
+    new rows only and the filter index extended rather than rebuilt.
+    Returns {source: error} for sources that could not be read.
+    """
+    state   = st.session_state.merge_state
+    data    = st.session_state.merged_data
+    profile = st.session_state.column_profile
+    dedup   = state['dedup']
+    mapping = state['mapping']
+    targets = state['targets']
+    blanks  = {c: null_dtype(dt) for c, dt in data.dtypes.items() if c in mapping}
+    columns = mapped_source_columns(new, mapping)
+    failed  = {}
+
+    def mapped(frame, fname):
+        frame = map_frame(frame, fname, mapping, targets, state['add_source'], blanks)
+        return frame if dedup is None else dedup.filter(frame, fname)
+
+    if is_store(data):
+        done, total = 0, sum(src.n_rows or 0 for src in new.values())
+        for fname, src in new.items():
+            # A file that fails part-way leaves no trace, so retrying it cannot duplicate rows
+            marks = [(obj, obj.checkpoint()) for obj in (data, profile, dedup) if obj is not None]
+            try:
+                for chunk in src.iter_chunks(columns[fname], MERGE_CHUNK_ROWS):
+                    part = mapped(chunk, fname)
+                    profile.update(part)
+                    data.append(part)
+                    done += len(chunk)
+                    if on_progress:
+                        on_progress(done, max(total, done))
+            except Exception as e:
+                for obj, mark in marks:
+                    obj.rollback(mark)
+                failed[fname] = str(e)
+        memory = None
+    else:
+        dfs, failed = load_sources(new, columns, on_progress and (lambda done, total, name: on_progress(done, total)))
+        # One concat for every file: if it fails, none of them leaves a trace
+        marks = [(obj, obj.checkpoint()) for obj in (profile, dedup) if obj is not None]
+        try:
+            part = pd.concat([mapped(df, fname) for fname, df in dfs.items()] or [data.iloc[:0]], ignore_index=True)
+            before = frame_nbytes(part)
+            if state['optimise']:
+                part = optimise_dtypes(part)
+            profile.update(part)
+            data = concat_merged(data, part)
+        except Exception as e:
+            for obj, mark in marks:
+                obj.rollback(mark)
+            return {**failed, **{fname: str(e) for fname in dfs}}
+        memory = st.session_state.merged_memory
+        memory = memory and (memory[0] + before, frame_nbytes(data))
+
+    cached = st.session_state.get('filter_index')
+    index  = cached[1] if cached and cached[0] == st.session_state.merged_token else None
+    state['sources'] += [f for f in new if f not in failed]
+    set_merged_data(data, profile, memory, state)
+    if index is not None:
+        index.extend(data)
+        st.session_state.filter_index = (st.session_state.merged_token, index)
+    return failed
+
+
+def render_join_options(sources, streaming):
+    """
+    Join settings, and the join's row-count plan once checked. Returns
+    {'keys', 'how', 'base', 'planned'} — None until key columns are chosen.
+    """
+    mapping  = st.session_state.column_mapping
+    fnames   = list(sources)
+    key_opts = [t for t, cols in mapping.items() if all(cols.get(f) for f in fnames)]
+    j1, j2, j3 = st.columns(3)
+    base = j1.selectbox("Base file", fnames, key="join_base",
+                        help="The (usually largest) file the others are joined onto; its rows are streamed.")
+    how  = JOIN_TYPES[j2.selectbox("Join type", list(JOIN_TYPES), key="join_how",
+                                   help="Left keeps every base row, Inner only matched rows, Outer every row of every file.")]
+    keys = j3.multiselect("Key columns", key_opts, key="join_keys", help="Target columns mapped in every file.")
+    if not key_opts:
+        st.warning("No target column is mapped in every file — map a shared key column in Step 2.")
+    if streaming and how == 'outer':
+        st.warning("Outer joins need the in-memory engine.")
+    if not keys:
+        return None
+
+    sig  = (tuple(keys), how, base, tuple(fnames), repr({k: mapping[k] for k in keys}))
+    plan = st.session_state.get('join_plan')
+    if st.button("🔍 Check join", help="Reads only the key columns and counts the rows the join will produce."):
+        with st.spinner("Reading key columns…"):
+            key_map = {k: mapping[k] for k in keys}
+            dfs, failed = load_sources(sources, {f: list(dict.fromkeys(key_map[k][f] for k in keys)) for f in fnames})
+            if failed:
+                for name, err in failed.items():
+                    st.error(f"Could not read {name}: {err}")
+                return None
+            key_frames = {f: map_frame(df, f, key_map, keys, False) for f, df in dfs.items()}
+            plan = st.session_state.join_plan = (sig, plan_join(key_frames, base, keys, how))
+    planned = plan is not None and plan[0] == sig
+    if planned:
+        result   = plan[1]
+        base_row = result['report'].iloc[0]['Rows']
+        growth   = result['rows'] / base_row if base_row else float('nan')
+        st.info(f"🔗 The join will produce **{result['rows']:,}** rows — {growth:.2f}× the base file.")
+        st.dataframe(result['report'], use_container_width=True, hide_index=True)
+        for w in result['warnings']:
+            st.warning(w)
+    else:
+        st.caption("Check the join to see how many rows it produces before merging.")
+    return {'keys': keys, 'how': how, 'base': base, 'planned': planned}
 
 
 def render_configure():
@@ -600,143 +2737,854 @@ def render_configure():
         <p>Choose merge options then click Merge!</p>
     </div>""", unsafe_allow_html=True)
 
-    dfs = st.session_state.file_dataframes
-    if not dfs:
+    sources = st.session_state.sources
+    if not sources:
         st.error("No files loaded.")
         back_button(1)
         return
 
-    st.info(f"📁 {len(dfs)} files | 🗂️ {len(st.session_state.column_mapping)} target columns mapped")
+    st.info(f"📁 {len(sources)} files | 🗂️ {len(st.session_state.column_mapping)} target columns mapped")
+
+    total_rows = sum(src.n_rows or 0 for src in sources.values())
+    engines    = ["In-memory", "Streaming (on-disk)"]
+    engine     = st.radio(
+        "Merge engine", engines,
+        index=1 if total_rows >= STREAMING_DEFAULT and pa is not None else 0,
+        horizontal=True,
+        disabled=pa is None,
+        help="Streaming writes the merge to disk in chunks of "
+             f"{MERGE_CHUNK_ROWS:,} rows, so memory stays bounded for very large merges "
+             "(requires pyarrow)."
+    )
+    streaming = engine == engines[1]
+
+    join = None
+    mode = st.radio(
+        "Merge mode", ["Stack rows", "Join on keys"], horizontal=True, key="merge_mode",
+        help="Stack appends the rows of every file. Join enriches a base file with the "
+             "columns of the other files, matched on key columns."
+    )
+    if mode == "Join on keys":
+        join = render_join_options(sources, streaming)
 
     col1, col2 = st.columns(2)
     with col1:
-        add_source = st.checkbox("Add '_source_file' column", value=True)
+        add_source = st.checkbox("Add '_source_file' column", value=True, disabled=mode != "Stack rows")
+        optimise   = st.checkbox(
+            "Optimise memory", value=True, disabled=streaming,
+            help="Store numbers in the smallest type that holds them exactly and repeated text as "
+                 "categories. Streaming merges live on disk and are not affected."
+        )
     with col2:
         handle_dupes = st.selectbox(
-            "Duplicate handling",
-            ["Keep All", "Remove Exact Duplicates", "Keep First", "Keep Last"]
+            "Duplicate handling", ["Keep All", "Remove Exact Duplicates", "Keep First", "Keep Last"],
+            help="Rows are compared by hash as each file is merged. "
+                 "'_source_file' is ignored, so the same row in two files counts as a duplicate."
         )
+        dedup_keys = None
+        if handle_dupes in ("Keep First", "Keep Last"):
+            dedup_keys = st.multiselect(
+                "Duplicate key columns", list(st.session_state.column_mapping),
+                help="Rows with equal values in these columns are duplicates. Empty = compare whole rows."
+            )
 
     col_left, col_right = st.columns(2)
     with col_left:
         back_button(2, "← Back to Column Mapping")
     with col_right:
-        if st.button("🚀 Merge Files!", type="primary", use_container_width=True):
+        blocked = mode != "Stack rows" and (join is None or not join['planned'] or (streaming and join['how'] == 'outer'))
+        if st.button("🚀 Join Files!" if mode != "Stack rows" else "🚀 Merge Files!", type="primary",
+                     use_container_width=True, disabled=blocked):
             with st.spinner("Merging…"):
                 mapping = st.session_state.column_mapping
                 if not mapping:
                     st.error("No column mapping defined. Please go back and configure mapping.")
                     return
-                merged = apply_mapping_and_merge(dfs, mapping, add_source, handle_dupes)
-                st.session_state.merged_data = merged
+                bar   = st.progress(0)
+                dedup = make_deduper(handle_dupes, dedup_keys)
+                if streaming:
+                    try:
+                        merged, profile = stream_mapping_and_merge(
+                            sources, mapping, add_source,
+                            on_progress=lambda done, total: bar.progress(done / max(total, 1)),
+                            dedup=dedup, join=join and (join['keys'], join['how'], join['base'])
+                        )
+                    except Exception as e:
+                        st.error(f"Merge failed: {e}")
+                        return
+                else:
+                    # Full parse happens only now, and only for the mapped columns
+                    dfs, failed = load_sources(
+                        sources, mapped_source_columns(sources, mapping),
+                        on_progress=lambda done, total, name: bar.progress(done / total)
+                    )
+                    if failed:
+                        for name, err in failed.items():
+                            st.error(f"Could not read {name}: {err}")
+                        return
+                    if join:
+                        merged = apply_mapping_and_join(dfs, mapping, join['keys'], join['how'], join['base'], dedup)
+                    else:
+                        merged = apply_mapping_and_merge(dfs, mapping, add_source, dedup)
+                    del dfs
+                    memory  = (frame_nbytes(merged),) * 2
+                    if optimise:
+                        merged = optimise_dtypes(merged)
+                        memory = (memory[0], frame_nbytes(merged))
+                    profile = ColumnProfile()
+                    profile.update(merged)
+                state = {'sources': list(sources), 'add_source': add_source and not join,
+                         'optimise': optimise and not streaming, 'dedup': dedup, 'join': join is not None,
+                         'mapping': {t: dict(cols) for t, cols in mapping.items()}, 'targets': list(mapping)}
+                set_merged_data(merged, profile, None if streaming else memory, state)
                 st.session_state.step = 4
                 st.rerun()
 
 
 # ─────────────────────────────────────────
-# STEP 4 – ANALYSE
+# FILTER ENGINE
 # ─────────────────────────────────────────
-def render_analysis():
-    st.markdown("""
-    <div class="step-card">
-        <h2>🔍 STEP 4: Analyse Data</h2>
-        <p>Filter, pivot, aggregate, and export your merged dataset.</p>
-    </div>""", unsafe_allow_html=True)
+class FilterIndex:
+    """
+    Lookup structures over the merged data, built once per merged dataset —
+    per column, the first time that column is filtered on:
+      - numeric:     values sorted once, so a range filter is two binary
+                     searches and a slice of row ids
+      - categorical: factorized codes, so a multiselect is a code lookup table
+      - text:        lower-cased strings, so "contains" is one literal scan
+    A filter evaluates to sorted positional row ids. The most selective
+    filter is resolved through its index; the others are only tested on the
+    rows that survived it. The merged frame itself is never copied.
+    """
 
-    df_orig = st.session_state.merged_data
-    if df_orig is None:
-        st.error("No merged data found.")
-        back_button(3)
+    def __init__(self, data):
+        self.data   = data
+        self.n      = len(data)
+        self.dtypes = data.dtypes
+        self._num   = {}  # col: (float values, sorted values, row order)
+        self._cat   = {}  # col: (codes + 1 — 0 is NaN, categories, counts per code)
+        self._txt   = {}  # col: lower-cased str Series
+
+    def _values(self, col):
+        return load_columns(self.data, [col])[col]
+
+    def _row_dtype(self):
+        return np.int32 if self.n < 2**31 else np.int64
+
+    # ── per-kind indexes ──
+    def _numeric(self, col):
+        if col not in self._num:
+            v     = self._values(col).to_numpy(dtype='float64', na_value=np.nan)
+            order = np.argsort(v, kind='stable').astype(self._row_dtype())  # NaNs sort last
+            self._num[col] = (v, v[order], order)
+        return self._num[col]
+
+    def _categorical(self, col):
+        if col not in self._cat:
+            codes, cats = pd.factorize(self._values(col), use_na_sentinel=True)
+            codes = (codes + 1).astype(np.int32)
+            self._cat[col] = (codes, pd.Index(cats), np.bincount(codes, minlength=len(cats) + 1))
+        return self._cat[col]
+
+    def _text(self, col):
+        if col not in self._txt:
+            self._txt[col] = self._values(col).astype(str).str.lower().reset_index(drop=True)
+        return self._txt[col]
+
+    def extend(self, data):
+        """
+        Carry the built indexes over to `data` — the indexed data with rows
+        appended — indexing only the new rows: sorted values take the new
+        ones by binary-search insertion, new category values get new codes.
+        """
+        old_n, dtypes = self.n, data.dtypes
+        self.data, self.n = data, len(data)
+        new_rows = np.arange(old_n, self.n)
+        for cache in (self._num, self._cat, self._txt):
+            for col in list(cache):
+                if (col not in dtypes or pd.api.types.is_numeric_dtype(dtypes[col])
+                        != pd.api.types.is_numeric_dtype(self.dtypes[col])):
+                    del cache[col]  # the column changed kind — rebuild it when next filtered on
+        self.dtypes = dtypes
+        for col, (v, sv, order) in self._num.items():
+            v_new = load_columns(data, [col], new_rows)[col].to_numpy(dtype='float64', na_value=np.nan)
+            o_new = np.argsort(v_new, kind='stable')
+            pos   = np.searchsorted(sv, v_new[o_new], 'right')
+            self._num[col] = (np.concatenate([v, v_new]), np.insert(sv, pos, v_new[o_new]),
+                              np.insert(order.astype(self._row_dtype()), pos, o_new + old_n))
+        for col, (codes, cats, counts) in self._cat.items():
+            values = load_columns(data, [col], new_rows)[col]
+            pos    = cats.get_indexer(values)
+            unseen = pd.unique(values[(pos < 0) & values.notna().to_numpy()])
+            if len(unseen):
+                cats = cats.append(pd.Index(unseen))
+                pos  = cats.get_indexer(values)
+            c_new = (pos + 1).astype(np.int32)
+            total = np.bincount(c_new, minlength=len(cats) + 1)
+            total[:len(counts)] += counts
+            self._cat[col] = (np.concatenate([codes, c_new]), cats, total)
+        for col, lowered in self._txt.items():
+            new = load_columns(data, [col], new_rows)[col].astype(str).str.lower()
+            self._txt[col] = pd.concat([lowered, new], ignore_index=True)
+        return self
+
+    # ── planning ──
+    def _plan(self, col, fval):
+        """
+        (estimated matches, rows(), test(rows)) for one filter, or None when it
+        keeps every row. rows() resolves the filter via the index; test(rows)
+        checks already-selected rows only.
+        """
+        if pd.api.types.is_numeric_dtype(self.dtypes[col]):
+            v, sv, order = self._numeric(col)
+            lo, hi = fval
+            a, b   = np.searchsorted(sv, lo, 'left'), np.searchsorted(sv, hi, 'right')
+            if a == 0 and b == self.n:
+                return None
+            return (b - a,
+                    lambda: np.sort(order[a:b]),
+                    lambda rows: (v[rows] >= lo) & (v[rows] <= hi))
+        if isinstance(fval, list):
+            if not fval:
+                return None
+            codes, cats, counts = self._categorical(col)
+            pos    = cats.get_indexer(fval)
+            lookup = np.zeros(len(cats) + 1, dtype=bool)
+            lookup[pos[pos >= 0] + 1] = True
+            if lookup[1:].all() and counts[0] == 0:
+                return None
+            return (int(counts[lookup].sum()),
+                    lambda: np.flatnonzero(lookup[codes]).astype(self._row_dtype()),
+                    lambda rows: lookup[codes[rows]])
+        if isinstance(fval, str) and fval:
+            lowered = self._text(col)
+            needle  = fval.lower()
+            return (self.n,  # unknown until scanned — resolve text filters last
+                    lambda: np.flatnonzero(lowered.str.contains(needle, regex=False, na=False).to_numpy(dtype=bool, na_value=False)),
+                    lambda rows: lowered.take(rows).str.contains(needle, regex=False, na=False).to_numpy(dtype=bool, na_value=False))
+        return None
+
+    def rows(self, filters):
+        """Sorted positional rows passing every filter in {col: value}, or None when nothing is filtered out."""
+        plans = [p for p in (self._plan(c, f) for c, f in filters.items()) if p is not None]
+        if not plans:
+            return None
+        plans.sort(key=lambda p: p[0])
+        rows = plans[0][1]()
+        for _, _, test in plans[1:]:
+            if not len(rows):
+                break
+            rows = rows[test(rows)]
+        return rows
+
+
+def get_filter_index(data):
+    """The FilterIndex of the current merged dataset, rebuilt only when a new merge replaces it."""
+    cached = st.session_state.get('filter_index')
+    token  = st.session_state.get('merged_token')
+    if cached is None or cached[0] != token or cached[1].data is not data:
+        cached = (token, FilterIndex(data))
+        st.session_state.filter_index = cached
+    return cached[1]
+
+
+# ─────────────────────────────────────────
+# RESULT CACHE
+# ─────────────────────────────────────────
+RESULT_CACHE_MAX_BYTES = int(os.environ.get("FMP_RESULT_CACHE_MB", "256")) * 1024 * 1024
+
+
+def result_nbytes(value):
+    """Approximate memory held by a cached result."""
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(index=True, deep=True).sum())
+    if isinstance(value, pd.Series):
+        return int(value.memory_usage(index=True, deep=True))
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    return 64
+
+
+class ResultCache:
+    """
+    Memoised analysis results — filtered row sets, describe stats, value
+    counts, pivots, group-bys — keyed by (merged-data fingerprint, filter
+    state, operation parameters). Bounded by `max_bytes`; the
+    least-recently-used results are evicted first. Lets reruns triggered by
+    unrelated widgets (paging, other sections) skip recomputation.
+    """
+
+    def __init__(self, max_bytes=RESULT_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.nbytes    = 0
+        self._items    = OrderedDict()  # key: (value, nbytes)
+
+    def get_or_compute(self, key, compute):
+        if key in self._items:
+            self._items.move_to_end(key)
+            return self._items[key][0]
+        value = compute()
+        size  = result_nbytes(value)
+        if size <= self.max_bytes:
+            self._items[key] = (value, size)
+            self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                _, (_, freed) = self._items.popitem(last=False)
+                self.nbytes -= freed
+        return value
+
+    def clear(self):
+        self._items.clear()
+        self.nbytes = 0
+
+
+def get_result_cache():
+    if st.session_state.get('result_cache') is None:
+        st.session_state.result_cache = ResultCache()
+    return st.session_state.result_cache
+
+
+# ─────────────────────────────────────────
+# AGGREGATION ENGINE
+# ─────────────────────────────────────────
+AGG_FUNCS       = ["sum", "mean", "count", "min", "max", "std", "median", "p25", "p75", "p95", "nunique"]
+AGG_QUANTILES   = {'median': 0.5, 'p25': 0.25, 'p75': 0.75, 'p95': 0.95}
+AGG_CHUNK_ROWS  = 1_000_000  # rows per partial aggregate
+AGG_WORKERS     = INGEST_WORKERS
+AGG_HASH_GROUPS = 100_000    # estimated groups above which rows are split by key hash, not by position
+QUANTILE_SKETCH = 1024       # samples kept per group and chunk; groups up to this size stay exact
+AGG_HELP        = (f"median / p25 / p75 / p95 are exact for groups of up to {QUANTILE_SKETCH} rows per "
+                   f"{AGG_CHUNK_ROWS:,}-row chunk and closely approximated beyond (pandas engine).")
+
+
+def group_ids(frame, by):
+    """Group number of every row (-1 where a key is missing), or all zeros without keys."""
+    if not by:
+        return np.zeros(len(frame), dtype=np.int64)
+    return frame.groupby(by, sort=False, observed=True, dropna=True).ngroup().fillna(-1).to_numpy(dtype=np.int64)
+
+
+def sketch_values(frame, by, gid, values):
+    """
+    Quantile sketch of `values` per group: every value of a group up to
+    QUANTILE_SKETCH rows (weight 1), else QUANTILE_SKETCH evenly spaced order
+    statistics weighted n / QUANTILE_SKETCH. Rows: the group keys, `v`, `w`.
+    """
+    v     = values.to_numpy(dtype='float64', na_value=np.nan)
+    keep  = np.flatnonzero((gid >= 0) & ~np.isnan(v))
+    order = keep[np.lexsort((v[keep], gid[keep]))]
+    g     = gid[order]
+    sizes = np.bincount(g, minlength=int(gid.max()) + 1 if len(gid) else 0)
+    start = np.cumsum(sizes) - sizes
+    big   = np.flatnonzero(sizes > QUANTILE_SKETCH)
+    small = sizes[g] <= QUANTILE_SKETCH
+    ranks = (np.arange(QUANTILE_SKETCH) + 0.5) / QUANTILE_SKETCH
+    picks = (start[big, None] + np.floor(ranks[None, :] * sizes[big, None])).astype(np.int64).ravel()
+    rows  = np.concatenate([order[small], order[picks]])
+    w     = np.concatenate([np.ones(int(small.sum())), np.repeat(sizes[big] / QUANTILE_SKETCH, QUANTILE_SKETCH)])
+    out   = frame[by].take(rows).reset_index(drop=True) if by else pd.DataFrame(index=pd.RangeIndex(len(rows)))
+    out['v'], out['w'] = v[rows], w
+    return out
+
+
+def sketch_quantile(state, by, q):
+    """
+    q-quantile per group of a sketch, interpolated linearly between samples
+    at their weight midpoints — numpy's 'linear' quantile when all weights are 1.
+    """
+    gid   = (state.groupby(by, sort=True, observed=True).ngroup().to_numpy() if by  # groups in key order
+             else np.zeros(len(state), dtype=np.int64))
+    order = np.lexsort((state['v'].to_numpy(), gid))
+    g, v, w = gid[order], state['v'].to_numpy()[order], state['w'].to_numpy()[order]
+    n_grp = int(g.max()) + 1 if len(g) else 0
+    W     = np.bincount(g, weights=w, minlength=n_grp)
+    ends  = np.cumsum(np.bincount(g, minlength=n_grp))
+    start = ends - np.bincount(g, minlength=n_grp)
+    cw    = np.cumsum(w)
+    mid   = cw - np.r_[0.0, cw][start][g] - w / 2          # weight midpoint of each sample within its group
+    t     = q * (W - 1) + 0.5
+    pos   = g + mid / (W[g] + 1)                             # one increasing axis across all groups
+    idx   = np.searchsorted(pos, np.arange(n_grp) + t / (W + 1))
+    hi    = np.clip(idx, start, ends - 1)
+    lo    = np.clip(idx - 1, start, ends - 1)
+    span  = mid[hi] - mid[lo]
+    frac  = np.clip(np.divide(t - mid[lo], span, out=np.zeros(n_grp), where=span > 0), 0, 1)
+    value = v[lo] + frac * (v[hi] - v[lo])
+    if not by:
+        return pd.Series(value)
+    keys = state[by].take(order[start])
+    return pd.Series(value, index=pd.MultiIndex.from_frame(keys) if len(by) > 1 else pd.Index(keys[by[0]]))
+
+
+class GroupStates:
+    """
+    Partial aggregates of value columns per group, mergeable across chunks:
+    count, sum, min, max and the sum of squared deviations (combined with
+    Chan's formula) for sum / count / mean / min / max / std; a quantile
+    sketch per group for median and percentiles (exact for groups up to
+    QUANTILE_SKETCH rows per chunk); the distinct (group, value) pairs for
+    nunique. Chunks are aggregated independently — in parallel — and merged;
+    merging onto fewer keys gives pivot margins without another scan.
+    """
+
+    def __init__(self, by, moments, sketches, distinct):
+        self.by       = by
+        self.moments  = moments   # {stat: DataFrame indexed by the keys, one column per value column}
+        self.sketches = sketches  # {col: DataFrame of keys, v, w}
+        self.distinct = distinct  # {col: DataFrame of keys, v}
+
+    @classmethod
+    def from_frame(cls, frame, by, cols, funcs):
+        g   = frame.groupby(by, sort=True, observed=True, dropna=True)[cols]
+        n   = g.count()
+        s   = g.sum(min_count=0) if cols else n
+        moments = {'n': n, 'sum': s}
+        if {'min', 'max'} & set(funcs):
+            moments['min'], moments['max'] = g.min(), g.max()
+        if 'std' in funcs:
+            moments['m2'] = (g.var(ddof=0) * n).fillna(0.0)
+        sketches, distinct = {}, {}
+        if set(AGG_QUANTILES) & set(funcs):
+            gid = group_ids(frame, by)
+            sketches = {c: sketch_values(frame, by, gid, frame[c]) for c in cols}
+        if 'nunique' in funcs:
+            distinct = {c: frame[by + [c]].dropna().drop_duplicates().rename(columns={c: 'v'}) for c in cols}
+        return cls(by, moments, sketches, distinct)
+
+    @classmethod
+    def merge(cls, parts, by, disjoint=False):
+        """
+        One GroupStates over `by` (the parts' keys or a subset of them, [] for
+        a grand total). The keys are factorised once; every moment is then a
+        ufunc.reduceat over the rows sorted by group. `disjoint` parts (no
+        group in two of them, same keys) are only concatenated in key order.
+        """
+        if disjoint and by == parts[0].by:
+            if len(parts) == 1:
+                return parts[0]
+            n     = pd.concat([p.moments['n'] for p in parts])
+            order = pd.Series(np.arange(len(n)), index=n.index).sort_index().to_numpy()
+            moments = {stat: pd.concat([p.moments[stat] for p in parts]).take(order) for stat in parts[0].moments}
+            sketches = {c: pd.concat([p.sketches[c] for p in parts], ignore_index=True) for c in parts[0].sketches}
+            distinct = {c: pd.concat([p.distinct[c] for p in parts], ignore_index=True) for c in parts[0].distinct}
+            return cls(by, moments, sketches, distinct)
+        stacked = {stat: pd.concat([p.moments[stat] for p in parts]) for stat in parts[0].moments}
+        n, s    = stacked['n'], stacked['sum']
+        if by:
+            groups = n.groupby(level=by, sort=True, observed=True)
+            gid, keys = groups.ngroup().to_numpy(), groups.size().index
+        else:
+            gid, keys = np.zeros(len(n), dtype=np.int64), pd.RangeIndex(min(len(n), 1))
+        order  = np.argsort(gid, kind='stable')
+        starts = np.flatnonzero(np.diff(gid[order], prepend=-1))
+
+        def reduce(ufunc, frame):
+            out = {}
+            for c in frame.columns:
+                v = frame[c].to_numpy()
+                if v.dtype.kind not in 'iuf':  # bool, nullable and extension columns
+                    v = frame[c].to_numpy(dtype='float64', na_value=np.nan)
+                out[c] = ufunc.reduceat(v[order], starts) if len(starts) else v[:0]
+            return pd.DataFrame(out, index=keys, columns=frame.columns)
+
+        moments = {'n': reduce(np.add, n), 'sum': reduce(np.add, s)}
+        if 'min' in stacked:  # fmin / fmax skip the NaN of a chunk's all-blank group
+            moments['min'], moments['max'] = reduce(np.fmin, stacked['min']), reduce(np.fmax, stacked['max'])
+        if 'm2' in stacked:
+            n_, s_ = (f.to_numpy(dtype='float64', na_value=np.nan) for f in (n, s))
+            total  = moments['n'].to_numpy(dtype='float64')
+            mean   = np.divide(moments['sum'].to_numpy(dtype='float64', na_value=np.nan), total,
+                               out=np.full(total.shape, np.nan), where=total > 0)[gid]
+            with np.errstate(invalid='ignore', divide='ignore'):
+                dev = np.nan_to_num(n_ * (s_ / n_ - mean) ** 2)
+            moments['m2'] = reduce(np.add, stacked['m2'] + dev)
+        keep = lambda frame: frame[by + [c for c in frame.columns if c not in parts[0].by]]
+        sketches = {c: pd.concat([keep(p.sketches[c]) for p in parts], ignore_index=True) for c in parts[0].sketches}
+        distinct = {c: pd.concat([keep(p.distinct[c]) for p in parts], ignore_index=True).drop_duplicates()
+                    for c in parts[0].distinct}
+        return cls(by, moments, sketches, distinct)
+
+    def result(self, cols, funcs):
+        """{(col, func): Series indexed by the keys}."""
+        m   = self.moments
+        out = {}
+        for c in cols:
+            n, s = m['n'][c], m['sum'][c]
+            for f in funcs:
+                if f == 'sum':
+                    r = s
+                elif f == 'count':
+                    r = n
+                elif f == 'mean':
+                    r = s / n.where(n > 0)
+                elif f in ('min', 'max'):
+                    r = m[f][c]
+                elif f == 'std':
+                    r = np.sqrt(m['m2'][c] / (n - 1).where(n > 1))
+                elif f in AGG_QUANTILES:
+                    r = sketch_quantile(self.sketches[c], self.by, AGG_QUANTILES[f])
+                else:  # nunique
+                    d = self.distinct[c]
+                    r = d.groupby(self.by, observed=True).size() if self.by else pd.Series([len(d)])
+                    r = r.reindex(n.index, fill_value=0)
+                if f in AGG_QUANTILES and self.by:
+                    r = r.reindex(n.index)
+                out[(c, f)] = r if self.by else pd.Series([r.iloc[0] if len(r) else np.nan])
+        return out
+
+
+def frame_chunks(fv, columns, chunk_rows=AGG_CHUNK_ROWS):
+    """Loaders of the filtered view in positional chunks — each materialises only its own rows."""
+    n = len(fv)
+    for a in range(0, n, chunk_rows):
+        if fv.rows is None and not is_store(fv.data):
+            yield lambda a=a: fv.data.iloc[a:a + chunk_rows][columns]  # rows first: copies only the chunk
+        else:
+            rows = np.arange(a, min(a + chunk_rows, n)) if fv.rows is None else fv.rows[a:a + chunk_rows]
+            yield lambda rows=rows: load_columns(fv.data, columns, rows)
+
+
+def key_partitions(fv, by, columns, n_parts):
+    """
+    Loaders of the filtered view split by a hash of the `by` keys, so each
+    group lies in exactly one partition — for keys too many to shrink much
+    when a chunk is pre-aggregated. An on-disk store is scanned once: each
+    Parquet partition is read and its rows dealt out to per-partition
+    buffers, rather than every loader re-reading every Parquet partition.
+    row_hashes() keeps a key in one partition even when its dtype differs
+    between Parquet partitions.
+    """
+    n = np.uint64(n_parts)
+    if not is_store(fv.data):
+        part = row_hashes(fv.load(by), by) % n
+        for k in range(n_parts):
+            rows = np.flatnonzero(part == k)
+            rows = rows if fv.rows is None else fv.rows[rows]
+            yield lambda rows=rows: load_columns(fv.data, columns, rows)
         return
 
-    # ── Sidebar-style filter panel ──
-    st.subheader("🎛️ Filters")
+    buffers = [[] for _ in range(n_parts)]
+    for frame in fv.data.iter_frames(columns, fv.rows):
+        part   = (row_hashes(frame, by) % n).astype(np.int64)
+        order  = np.argsort(part, kind='stable')
+        bounds = np.cumsum(np.bincount(part, minlength=n_parts))[:-1]
+        for k, rows in enumerate(np.split(order, bounds)):
+            if len(rows):
+                buffers[k].append(frame.take(rows))
+    empty = load_columns(fv.data, columns, np.arange(0))
 
-    cols_all   = df_orig.columns.tolist()
-    filter_cols = st.multiselect("Select columns to filter on", cols_all, key="filter_cols")
+    def load(k):
+        frames, buffers[k] = buffers[k], None  # hand the rows over — the buffer is not kept
+        return pd.concat(frames, ignore_index=True) if frames else empty
+
+    for k in range(n_parts):
+        yield lambda k=k: load(k)
 
-    filters = {}
-    if filter_cols:
-        fcols = st.columns(min(len(filter_cols), 3))
-        for i, col in enumerate(filter_cols):
-            with fcols[i % 3]:
-                dtype = df_orig[col].dtype
-                if pd.api.types.is_numeric_dtype(dtype):
-                    mn, mx = float(df_orig[col].min()), float(df_orig[col].max())
-                    if mn == mx:
-                        st.info(f"{col}: constant value {mn}")
-                        filters[col] = (mn, mx)
-                    else:
-                        filters[col] = st.slider(col, mn, mx, (mn, mx), key=f"filter_{col}")
-                else:
-                    unique_vals = df_orig[col].dropna().unique().tolist()
-                    if len(unique_vals) <= 100:
-                        sel = st.multiselect(col, unique_vals, default=unique_vals, key=f"filter_{col}")
-                        filters[col] = sel
-                    else:
-                        txt = st.text_input(f"{col} (contains)", key=f"filter_{col}")
-                        filters[col] = txt
 
-    # Apply filters
-    df = df_orig.copy()
+def estimated_groups(fv, by):
+    """Upper estimate of the groups over `by`: the product of the keys' distinct counts, at most the rows."""
+    est = 1
+    for col in by:
+        est *= fv.profile[col]['distinct'] if col in fv.profile else len(fv)
+    return min(est, len(fv))
+
+
+def partitioned_states(fv, by, cols, funcs):
+    """
+    GroupStates of the filtered view: partitions aggregated concurrently,
+    then merged. Few groups: positional chunks, whose small partial states
+    merge cheaply. Many groups: partitions by key hash (one per worker, or
+    per AGG_CHUNK_ROWS rows of an on-disk store), which need no merging.
+    """
+    columns  = list(dict.fromkeys(by + cols))
+    disjoint = bool(by) and estimated_groups(fv, by) > AGG_HASH_GROUPS
+    if disjoint:
+        n_parts = AGG_WORKERS if not is_store(fv.data) else max(AGG_WORKERS, -(-len(fv) // AGG_CHUNK_ROWS))
+        chunks  = list(key_partitions(fv, by, columns, n_parts))
+    else:
+        chunks  = list(frame_chunks(fv, columns)) or [lambda: load_columns(fv.data, columns, np.arange(0))]
+    work = lambda load: GroupStates.from_frame(load(), by, cols, funcs)
+    if len(chunks) == 1 or AGG_WORKERS == 1:
+        parts = [work(load) for load in chunks]
+    else:
+        with ThreadPoolExecutor(max_workers=AGG_WORKERS) as ex:
+            parts = list(ex.map(work, chunks))
+    return GroupStates.merge(parts, by, disjoint=disjoint or len(parts) == 1)
+
+
+# ─────────────────────────────────────────
+# QUERY ENGINE (optional DuckDB)
+# ─────────────────────────────────────────
+SQL_AGGS      = {'sum': 'sum({})', 'mean': 'avg({})', 'count': 'count({})', 'min': 'min({})', 'max': 'max({})',
+                 'std': 'stddev_samp({})', 'nunique': 'count(DISTINCT {})',
+                 **{f: f'quantile_cont({{}}, {q})' for f, q in AGG_QUANTILES.items()}}
+SQL_MAX_ROWS  = 10_000  # rows of a SQL result shown on the page
+HAS_DUCKDB    = importlib.util.find_spec('duckdb') is not None
+
+
+def sql_ident(name):
+    return '"' + str(name).replace('"', '""') + '"'
+
+
+def sql_literal(value):
+    if isinstance(value, (bool, np.bool_)):
+        return 'TRUE' if value else 'FALSE'
+    if isinstance(value, (int, float, np.integer, np.floating)):
+        return repr(float(value)) if isinstance(value, (float, np.floating)) else str(int(value))
+    if isinstance(value, (pd.Timestamp, datetime)):
+        return f"TIMESTAMP '{pd.Timestamp(value).tz_localize(None).isoformat(sep=' ')}'"
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def filter_sql(filters):
+    """The filter state of the analysis page as one SQL condition — the same rows FilterIndex.rows() selects."""
+    conds = []
     for col, fval in filters.items():
-        if pd.api.types.is_numeric_dtype(df[col].dtype):
-            df = df[(df[col] >= fval[0]) & (df[col] <= fval[1])]
-        elif isinstance(fval, list):
-            if fval:
-                df = df[df[col].isin(fval)]
+        c = sql_ident(col)
+        if isinstance(fval, tuple):  # compared as float64, like FilterIndex — bool columns included
+            conds.append(f"CAST({c} AS DOUBLE) BETWEEN {sql_literal(fval[0])} AND {sql_literal(fval[1])}")
+        elif isinstance(fval, list) and fval:
+            conds.append(f"{c} IN ({', '.join(map(sql_literal, fval))})")
         elif isinstance(fval, str) and fval:
-            df = df[df[col].astype(str).str.contains(fval, case=False, na=False)]
+            conds.append(f"contains(lower(CAST({c} AS VARCHAR)), {sql_literal(fval.lower())})")
+    return " AND ".join(conds) or "TRUE"
 
-    # ── Dataset stats ──
-    c1, c2, c3, c4 = st.columns(4)
-    c1.metric("Filtered Rows", f"{len(df):,}")
-    c2.metric("Total Rows",    f"{len(df_orig):,}")
-    c3.metric("Columns",       len(df.columns))
-    c4.metric("% Retained",    f"{100*len(df)/max(len(df_orig),1):.1f}%")
 
-    # ── Data preview ──
+def duckdb_connect(data):
+    """
+    In-process DuckDB over the merged data, registered as `merged`: a
+    DataFrame is scanned in place, a MergedStore as a pyarrow dataset over
+    its Parquet partitions. DuckDB itself never opens a file, so external
+    access is switched off entirely and the setting locked — the SQL tab
+    runs whatever the user types (see duckdb_query).
+    """
+    require('duckdb')
+    import duckdb
+    con = duckdb.connect()
+    if is_store(data) and not data.parts:
+        con.execute("CREATE VIEW merged AS SELECT NULL AS empty WHERE FALSE")
+    elif is_store(data):
+        import pyarrow.dataset as pads
+        con.register('merged', pads.dataset([p for p, _ in data.parts], schema=data.arrow_schema(), format='parquet'))
+    else:
+        con.register('merged', data)
+    con.execute("SET enable_external_access = false")
+    con.execute("SET lock_configuration = true")
+    return con
+
+
+def get_duckdb(data):
+    """The DuckDB connection of the current merged dataset, reopened only when a new merge replaces it."""
+    cached = st.session_state.get('duckdb')
+    token  = st.session_state.get('merged_token')
+    if cached is None or cached[0] != token:
+        if cached is not None:
+            cached[1].close()
+        cached = (token, duckdb_connect(data))
+        st.session_state.duckdb = cached
+    return cached[1]
+
+
+def duckdb_pivot(con, filters, index, columns, values, aggfunc):
+    """
+    pivot_result() in one DuckDB query: cells and margins come from a single
+    GROUPING SETS pass instead of pandas re-aggregating for every margin.
+    """
+    i, v = sql_ident(index), sql_ident(values)
+    agg  = SQL_AGGS[aggfunc].format(v)
+    if columns:
+        c    = sql_ident(columns)
+        sql  = (f"SELECT {i} AS i, {c} AS c, grouping({i}) AS gi, grouping({c}) AS gc, {agg} AS val "
+                f"FROM merged WHERE ({filter_sql(filters)}) AND {i} IS NOT NULL AND {c} IS NOT NULL "
+                f"GROUP BY GROUPING SETS (({i}, {c}), ({i}), ({c}), ())")
+    else:
+        sql  = (f"SELECT {i} AS i, grouping({i}) AS gi, 0 AS gc, {agg} AS val "
+                f"FROM merged WHERE ({filter_sql(filters)}) AND {i} IS NOT NULL GROUP BY GROUPING SETS (({i}), ())")
+    long  = con.execute(sql).df()
+    cells = long[(long.gi == 0) & (long.gc == 0)]
+    if not columns:
+        out = cells.set_index('i')[['val']].sort_index()
+        out.loc["Total"] = long.loc[long.gi == 1, 'val'].iloc[0]
+        out.index.name, out.columns = index, [values]
+        return out
+    out = cells.pivot(index='i', columns='c', values='val').sort_index().sort_index(axis=1)
+    out["Total"] = long[(long.gi == 0) & (long.gc == 1)].set_index('i')['val']
+    total_row    = long[(long.gi == 1) & (long.gc == 0)].set_index('c')['val']
+    total_row["Total"] = long.loc[(long.gi == 1) & (long.gc == 1), 'val'].iloc[0]
+    out.loc["Total"] = total_row
+    out.index.name, out.columns.name = index, columns
+    return out
+
+
+def duckdb_groupby(con, filters, by, cols, funcs):
+    """groupby_result() as one parallel DuckDB aggregation."""
+    keys = ", ".join(map(sql_ident, by))
+    aggs = ", ".join(f"{SQL_AGGS[f].format(sql_ident(c))} AS {sql_ident(f'{c}_{f}')}" for c in cols for f in funcs)
+    notnull = " AND ".join(f"{sql_ident(b)} IS NOT NULL" for b in by)
+    return con.execute(f"SELECT {keys}, {aggs} FROM merged WHERE ({filter_sql(filters)}) AND {notnull} "
+                       f"GROUP BY {keys} ORDER BY {keys}").df()
+
+
+def duckdb_query(con, filters, query, max_rows=SQL_MAX_ROWS):
+    """
+    A free-form SQL query, with `filtered` = the merged data under the page's
+    filters. Only a single SELECT is run, so user SQL can neither change the
+    connection (DROP, SET, ATTACH) nor write files (COPY). Returns its first
+    `max_rows` + 1 rows (one more than shown, to tell a cut-off result).
+    """
+    import duckdb
+    statements = con.extract_statements(query)
+    if len(statements) != 1 or statements[0].type != duckdb.StatementType.SELECT:
+        raise ValueError("only a single SELECT query can be run")
+    con.execute(f"CREATE OR REPLACE TEMP VIEW filtered AS SELECT * FROM merged WHERE {filter_sql(filters)}")
+    return con.sql(query).limit(max_rows + 1).df()
+
+
+# ─────────────────────────────────────────
+# STEP 4 – ANALYSE
+# ─────────────────────────────────────────
+class FilteredView:
+    """
+    The filtered merged data as handed to each analysis section — the
+    sections' only data dependency. Rows stay positional ids into the merged
+    data; columns are materialised per section, on demand.
+    """
+
+    def __init__(self, data, rows, state, profile, filters=None, engine='pandas'):
+        self.data    = data
+        self.rows    = rows      # sorted positional ids, None = all rows
+        self.state   = state     # (merged fingerprint, filter state) — prefix of every cache key
+        self.profile = profile
+        self.filters = filters or {}  # {col: filter value} — what `rows` was selected by
+        self.engine  = engine    # 'pandas' | 'duckdb' — runs pivots and group-bys
+
+    def __len__(self):
+        return len(self.data) if self.rows is None else len(self.rows)
+
+    def load(self, columns=None):
+        return load_columns(self.data, columns, self.rows)
+
+    def key(self, *params):
+        return self.state + params
+
+
+WORKBOOK_SHEETS = ["FilteredData", "NumericStats", "ValueCounts", "Pivot", "GroupBy"]  # sheet order
+
+
+def register_sheet(name, key=None, data=None, rows=None):
+    """Record (or, with no data, drop) the table a section currently shows for the analysis workbook."""
+    sheets = st.session_state.setdefault('workbook_sheets', {})
+    if data is None:
+        sheets.pop(name, None)
+    else:
+        sheets[name] = (key, data, rows)
+    for n in WORKBOOK_SHEETS:  # keep a stable sheet order whatever order sections register in
+        if n in sheets:
+            sheets[n] = sheets.pop(n)
+
+
+def describe_stats(fv, num_cols):
+    return fv.load(num_cols).describe().T.reset_index().rename(columns={'index': 'Column'})
+
+
+def value_counts_table(fv, col):
+    vc = fv.load([col])[col].value_counts()
+    vc = vc[vc > 0].reset_index()  # a categorical also lists its unused categories
+    vc.columns = [col, 'Count']
+    vc['%'] = (vc['Count'] / vc['Count'].sum() * 100).round(2)
+    return vc
+
+
+def pivot_result(fv, index, columns, values, aggfunc):
+    if fv.engine == 'duckdb':
+        return duckdb_pivot(get_duckdb(fv.data), fv.filters, index, columns, values, aggfunc)
+    # Cells and margins from one partitioned pass: margins merge the cells' partial states
+    states = partitioned_states(fv, [index] + ([columns] if columns else []), [values], [aggfunc])
+    agg    = lambda st_: st_.result([values], [aggfunc])[(values, aggfunc)]
+    total  = agg(GroupStates.merge([states], [])).iloc[0]
+    if not columns:
+        out = agg(states).to_frame(values)
+        out.index = out.index.astype(object)
+        out.loc["Total"] = total
+        return out
+    out = agg(states).unstack(columns)
+    out.index, out.columns = out.index.astype(object), out.columns.astype(object)
+    out["Total"]     = agg(GroupStates.merge([states], [index]))
+    out.loc["Total"] = pd.concat([agg(GroupStates.merge([states], [columns])), pd.Series({"Total": total})])
+    return out
+
+
+def groupby_result(fv, by, cols, funcs):
+    if fv.engine == 'duckdb':
+        return duckdb_groupby(get_duckdb(fv.data), fv.filters, by, cols, funcs)
+    results = partitioned_states(fv, by, cols, funcs).result(cols, funcs)
+    return pd.DataFrame({f"{c}_{f}": r for (c, f), r in results.items()}).reset_index()
+
+
+def section_timer(t0):
+    """Caption with the time this section took in the current (full or fragment) run."""
+    st.caption(f"⏱ {1000 * (time.perf_counter() - t0):,.0f} ms")
+
+
+@st.fragment
+def analysis_preview(fv):
+    t0 = time.perf_counter()
     st.markdown("---")
     st.subheader("📄 Data Preview")
-    chunked_display(df, "analysis")
+    chunked_display(fv.data, "analysis", fv.rows)
 
-    link, fname = to_download_link(df, 'csv', f"filtered_{datetime.now().strftime('%Y%m%d_%H%M%S')}")
-    st.markdown(link, unsafe_allow_html=True)
+    export_button(fv.data, 'csv', f"filtered_{datetime.now().strftime('%Y%m%d_%H%M%S')}",
+                  fv.state, "dl_filtered", fv.rows)
+    register_sheet("FilteredData", fv.state, fv.data, fv.rows)
+    section_timer(t0)
 
-    # ── Column statistics ──
+
+@st.fragment
+def analysis_stats(fv):
+    t0 = time.perf_counter()
     st.markdown("---")
     st.subheader("📊 Column Statistics")
 
-    num_cols = df.select_dtypes(include='number').columns.tolist()
-    cat_cols = df.select_dtypes(exclude='number').columns.tolist()
+    results  = get_result_cache()
+    num_cols = fv.profile.numeric_columns()
+    cat_cols = fv.profile.other_columns()
 
     tab_num, tab_cat = st.tabs(["🔢 Numeric Columns", "🔤 Categorical Columns"])
 
     with tab_num:
         if num_cols:
-            stat_df = df[num_cols].describe().T.reset_index().rename(columns={'index': 'Column'})
+            key     = fv.key('describe', tuple(num_cols))
+            stat_df = results.get_or_compute(key, lambda: describe_stats(fv, num_cols))
             st.dataframe(stat_df, use_container_width=True, hide_index=True)
-            link2, _ = to_download_link(stat_df, 'csv', "numeric_stats")
-            st.markdown(link2, unsafe_allow_html=True)
+            export_button(stat_df, 'csv', "numeric_stats", key, "dl_stats")
+            register_sheet("NumericStats", key, stat_df)
         else:
             st.info("No numeric columns.")
+            register_sheet("NumericStats")
 
     with tab_cat:
         if cat_cols:
             sel_cat = st.selectbox("Select column for value counts", cat_cols, key="cat_col_sel")
-            vc = df[sel_cat].value_counts().reset_index()
-            vc.columns = [sel_cat, 'Count']
-            vc['%'] = (vc['Count'] / vc['Count'].sum() * 100).round(2)
+            key = fv.key('value_counts', sel_cat)
+            vc  = results.get_or_compute(key, lambda: value_counts_table(fv, sel_cat))
             st.dataframe(vc.head(50), use_container_width=True, hide_index=True)
-            link3, _ = to_download_link(vc, 'csv', f"value_counts_{sel_cat}")
-            st.markdown(link3, unsafe_allow_html=True)
+            export_button(vc, 'csv', f"value_counts_{sel_cat}", key, "dl_value_counts")
+            register_sheet("ValueCounts", key, vc)
         else:
             st.info("No categorical columns.")
+            register_sheet("ValueCounts")
+    section_timer(t0)
+
 
-    # ── Pivot Table ──
+@st.fragment
+def analysis_pivot(fv):
+    t0 = time.perf_counter()
     st.markdown("---")
     st.subheader("🔄 Pivot Table")
 
+    cols_all = fv.profile.columns
+    num_cols = fv.profile.numeric_columns()
+
     p1, p2, p3, p4 = st.columns(4)
     with p1:
         pivot_index = st.selectbox("Row (Index)", ["—"] + cols_all, key="piv_idx")
@@ -745,56 +3593,187 @@ def render_analysis():
     with p3:
         pivot_vals  = st.selectbox("Values",  ["—"] + num_cols,  key="piv_vals")
     with p4:
-        pivot_agg   = st.selectbox("Aggregation", ["sum","mean","count","min","max","std"], key="piv_agg")
+        pivot_agg   = st.selectbox("Aggregation", AGG_FUNCS, key="piv_agg", help=AGG_HELP)
 
     if pivot_index != "—" and pivot_vals != "—":
         try:
-            pvt_kw = dict(
-                index=pivot_index,
-                values=pivot_vals,
-                aggfunc=pivot_agg,
-                margins=True,
-                margins_name="Total"
+            columns = None if pivot_cols == "—" else pivot_cols
+            key = fv.key('pivot', pivot_index, columns, pivot_vals, pivot_agg, fv.engine)
+            pvt = get_result_cache().get_or_compute(
+                key, lambda: pivot_result(fv, pivot_index, columns, pivot_vals, pivot_agg)
             )
-            if pivot_cols != "—":
-                pvt_kw['columns'] = pivot_cols
-
-            pvt = pd.pivot_table(df, **pvt_kw)
             st.dataframe(pvt, use_container_width=True)
-            link4, _ = to_download_link(pvt.reset_index(), 'csv', "pivot_table")
-            st.markdown(link4, unsafe_allow_html=True)
+            export_button(pvt.reset_index(), 'csv', "pivot_table", key, "dl_pivot")
+            register_sheet("Pivot", key, pvt.reset_index())
         except Exception as e:
             st.error(f"Pivot error: {e}")
+            register_sheet("Pivot")
     else:
         st.info("Select at least Row and Values to generate a pivot table.")
+        register_sheet("Pivot")
+    section_timer(t0)
+
 
-    # ── Aggregation ──
+@st.fragment
+def analysis_groupby(fv):
+    t0 = time.perf_counter()
     st.markdown("---")
     st.subheader("📐 Group-By Aggregation")
 
+    num_cols = fv.profile.numeric_columns()
+    cat_cols = fv.profile.other_columns()
+
     g1, g2, g3 = st.columns(3)
     with g1:
         grp_by = st.multiselect("Group by", cat_cols + num_cols, key="grp_by")
     with g2:
         agg_col = st.multiselect("Aggregate columns", num_cols, key="agg_col")
     with g3:
-        agg_fn  = st.multiselect("Functions", ["sum","mean","count","min","max","std"], default=["sum","count"], key="agg_fn")
+        agg_fn  = st.multiselect("Functions", AGG_FUNCS, default=["sum","count"], key="agg_fn", help=AGG_HELP)
 
     if grp_by and agg_col and agg_fn:
         try:
-            agg_dict = {c: agg_fn for c in agg_col}
-            agg_result = df.groupby(grp_by).agg(agg_dict).reset_index()
-            agg_result.columns = [
-                f"{c[0]}_{c[1]}" if isinstance(c, tuple) and c[1] else c[0] if isinstance(c, tuple) else c
-                for c in agg_result.columns
-            ]
+            key        = fv.key('groupby', tuple(grp_by), tuple(agg_col), tuple(agg_fn), fv.engine)
+            agg_result = get_result_cache().get_or_compute(
+                key, lambda: groupby_result(fv, grp_by, agg_col, agg_fn)
+            )
             st.dataframe(agg_result, use_container_width=True, hide_index=True)
-            link5, _ = to_download_link(agg_result, 'csv', "aggregation")
-            st.markdown(link5, unsafe_allow_html=True)
+            export_button(agg_result, 'csv', "aggregation", key, "dl_aggregation")
+            register_sheet("GroupBy", key, agg_result)
         except Exception as e:
             st.error(f"Aggregation error: {e}")
+            register_sheet("GroupBy")
     else:
         st.info("Select Group-by, Aggregate columns and Functions to generate results.")
+        register_sheet("GroupBy")
+    section_timer(t0)
+
+
+@st.fragment
+def analysis_sql(fv):
+    t0 = time.perf_counter()
+    st.markdown("---")
+    st.subheader("🦆 SQL")
+    if not HAS_DUCKDB:
+        st.caption(f"Install `duckdb` for {OPTIONAL_DEPS['duckdb']}.")
+        return
+    st.caption("Query the merged data as `merged` — or `filtered`, with the filters above applied. "
+               "Runs in-process on DuckDB, in parallel. Only SELECT queries are run, and files on the "
+               "server are not reachable.")
+    query = st.text_area("SQL", "SELECT * FROM filtered LIMIT 100", key="sql_query", height=120)
+    if query.strip():
+        try:
+            key    = fv.key('sql', query)
+            result = get_result_cache().get_or_compute(
+                key, lambda: duckdb_query(get_duckdb(fv.data), fv.filters, query)
+            )
+            if len(result) > SQL_MAX_ROWS:
+                st.caption(f"First {SQL_MAX_ROWS:,} rows shown.")
+                result = result.head(SQL_MAX_ROWS)
+            st.dataframe(result, use_container_width=True, hide_index=True)
+            export_button(result, 'csv', "query", key, "dl_sql")
+        except Exception as e:
+            st.error(f"SQL error: {e}")
+    section_timer(t0)
+
+
+def render_analysis():
+    st.markdown("""
+    <div class="step-card">
+        <h2>🔍 STEP 4: Analyse Data</h2>
+        <p>Filter, pivot, aggregate, and export your merged dataset.</p>
+    </div>""", unsafe_allow_html=True)
+
+    df_orig = st.session_state.merged_data
+    if df_orig is None:
+        st.error("No merged data found.")
+        back_button(3)
+        return
+
+    state      = st.session_state.get('merge_state')
+    duplicates = state['dedup'].dropped if state and state['dedup'] is not None else None
+    if duplicates is not None:
+        removed = sum(duplicates.values())
+        with st.expander(f"🧹 {removed:,} duplicate row(s) removed during the merge", expanded=False):
+            if removed:
+                report = pd.DataFrame({"File": list(duplicates), "Duplicates removed": list(duplicates.values())})
+                st.dataframe(report, use_container_width=True, hide_index=True)
+            else:
+                st.caption("No duplicates found.")
+
+    # ── Sidebar-style filter panel ──
+    st.subheader("🎛️ Filters")
+
+    profile    = get_column_profile(df_orig)
+    cols_all   = df_orig.columns.tolist()
+    filter_cols = st.multiselect("Select columns to filter on", cols_all, key="filter_cols")
+
+    filters = {}
+    if filter_cols:
+        fcols = st.columns(min(len(filter_cols), 3))
+        for i, col in enumerate(filter_cols):
+            with fcols[i % 3]:
+                p = profile[col]
+                if p['numeric']:
+                    mn, mx = p['min'], p['max']
+                    if mn is None:
+                        st.info(f"{col}: no values")
+                    elif mn == mx:
+                        st.info(f"{col}: constant value {mn}")
+                        filters[col] = (mn, mx)
+                    else:
+                        filters[col] = st.slider(col, mn, mx, (mn, mx), key=f"filter_{col}")
+                else:
+                    if p['exact'] and p['distinct'] <= PROFILE_TOP_K:
+                        unique_vals = p['values']
+                        sel = st.multiselect(col, unique_vals, default=unique_vals, key=f"filter_{col}")
+                        filters[col] = sel
+                    else:
+                        txt = st.text_input(f"{col} (contains)", key=f"filter_{col}")
+                        filters[col] = txt
+
+    with st.expander("🧾 Column profile"):
+        st.dataframe(profile.summary(), use_container_width=True, hide_index=True)
+
+    engine = 'pandas'
+    if HAS_DUCKDB:
+        engine = st.radio(
+            "Aggregation engine", ["duckdb", "pandas"], horizontal=True, key="query_engine",
+            format_func={"duckdb": "DuckDB (parallel)", "pandas": "pandas (partitioned)"}.get,
+            help="DuckDB computes pivots (margins included) and group-bys in one parallel pass "
+                 "over the merged data, without building filtered copies. pandas aggregates "
+                 "chunks of the filtered rows on a thread pool and merges the partial results."
+        )
+
+    # Everything below is memoised per (merged data, filter state, parameters)
+    results = get_result_cache()
+    state   = (st.session_state.merged_token, json.dumps(filters, default=str, sort_keys=True))
+
+    # Apply filters — row-id intersections through the per-dataset index, no frame copies
+    rows = results.get_or_compute(state + ('rows',), lambda: get_filter_index(df_orig).rows(filters))
+    fv   = FilteredView(df_orig, rows, state, profile, filters, engine)
+
+    # ── Dataset stats ──
+    c1, c2, c3, c4 = st.columns(4)
+    c1.metric("Filtered Rows", f"{len(fv):,}")
+    c2.metric("Total Rows",    f"{len(df_orig):,}")
+    c3.metric("Columns",       len(cols_all))
+    c4.metric("% Retained",    f"{100*len(fv)/max(len(df_orig),1):.1f}%")
+
+    # Each section is a fragment: its own widgets rerun only that section
+    analysis_preview(fv)
+    analysis_stats(fv)
+    analysis_pivot(fv)
+    analysis_groupby(fv)
+    analysis_sql(fv)
+
+    # ── One workbook with everything above ──
+    st.markdown("---")
+    st.subheader("📦 Analysis Workbook")
+    st.caption("Filtered data, statistics, value counts, pivot and group-by results as currently shown — "
+               "one sheet each, written in a single streaming pass.")
+    workbook_button(st.session_state.setdefault('workbook_sheets', {}),
+                    f"analysis_{datetime.now().strftime('%Y%m%d_%H%M%S')}", "dl_workbook")
 
     # ── Navigation ──
     st.markdown("---")
@@ -826,22 +3805,29 @@ def render_download():
     c1, c2, c3 = st.columns(3)
     c1.metric("Rows",    f"{len(df):,}")
     c2.metric("Columns", len(df.columns))
-    c3.metric("Files merged", len(st.session_state.file_dataframes))
+    c3.metric("Files merged", len(st.session_state.sources))
 
     col1, col2 = st.columns(2)
     with col1:
         fname_base = st.text_input("Filename (without extension)",
                                    value=f"merged_{datetime.now().strftime('%Y%m%d_%H%M%S')}")
     with col2:
-        fmt = st.selectbox("Format", ['csv', 'excel', 'json'])
+        fmt = st.selectbox("Format", ['csv', 'excel', 'json', 'ndjson'] + (['parquet', 'feather'] if pa is not None else []),
+                           help="Parquet and Feather keep column types and are compressed (requires pyarrow).")
+        if fmt == 'csv':
+            codecs = {"None": 'csv', "gzip": 'csv.gz'}
+            if probe_dependencies().get('zstandard'):
+                codecs["zstd"] = 'csv.zst'
+            fmt = codecs[st.selectbox("Compression", list(codecs),
+                                      help="Compressed on the fly while the CSV is streamed to disk.")]
 
     with st.expander("👁️ Preview (first 100 rows)", expanded=True):
         chunked_display(df.head(100), "download_preview")
 
     st.markdown("---")
-    link, full_name = to_download_link(df, fmt, fname_base)
+    full_name = f"{fname_base}.{EXPORT_FORMATS[fmt][0]}"
     st.markdown(f"### 📥 {full_name}")
-    st.markdown(link, unsafe_allow_html=True)
+    export_button(df, fmt, fname_base, st.session_state.merged_token, "dl_merged")
 
     st.markdown("---")
     back_button(4, "← Back to Analysis")
@@ -855,13 +3841,13 @@ def render_features_page():
     st.markdown('<p class="sub-header">Everything you can do with File Merger Pro</p>', unsafe_allow_html=True)
 
     features = [
-        ("📁 Multi-Format Upload", "Upload CSV, Excel (.xlsx/.xls), JSON, and TXT files. Mix different formats freely. Up to 100 files in a single session."),
+        ("📁 Multi-Format Upload", "Upload CSV, Excel (.xlsx/.xls), JSON/NDJSON, TXT, Parquet and Arrow/Feather files. Mix different formats freely. Up to 100 files in a single session."),
         ("🔗 Automatic Column Mapping", "Columns with the same name (case-insensitive) are mapped automatically across all files. A clear summary shows you which columns match."),
         ("🗂️ Manual Column Mapping", "For columns that appear in only some files, choose to include them (filling missing rows with blanks) or skip them entirely. You can also manually map differently-named columns from specific files."),
-        ("⚙️ Flexible Merge Options", "Add a source-file column to track which row came from which file. Control duplicate handling: keep all, remove exact duplicates, keep first, or keep last occurrence."),
+        ("⚙️ Flexible Merge Options", "Stack files or join them on key columns (left, inner or outer), with the row count checked before the join runs. Add a source-file column to track which row came from which file. Control duplicate handling: keep all, remove exact duplicates, or keep the first or last row per key columns. Step 4 shows how many duplicates each file had."),
         ("🔍 Interactive Filters", "Filter numeric columns using range sliders. Filter categorical columns using multi-select dropdowns. Apply text search filters for high-cardinality columns. All filters are applied in real time."),
         ("📊 Column Statistics", "Instantly see descriptive statistics (min, max, mean, std, quartiles) for all numeric columns. View value counts and percentages for categorical columns."),
-        ("🔄 Pivot Tables", "Create pivot tables with any row, column, and value combination. Choose from sum, mean, count, min, max, or std aggregation. Totals are included automatically."),
+        ("🔄 Pivot Tables", "Create pivot tables with any row, column, and value combination. Choose from sum, mean, count, min, max, std, median, percentiles (p25 / p75 / p95) or distinct count. Totals are included automatically."),
         ("📐 Group-By Aggregation", "Group data by any column(s) and apply multiple aggregation functions to numeric columns simultaneously."),
         ("📄 Paginated Preview", "Large datasets (50,000+ rows) are displayed page by page to keep the app fast and responsive."),
         ("📥 Flexible Export", "Every table, filter result, pivot, and aggregation has its own download button. Export as CSV, Excel, or JSON. File names include timestamps to avoid confusion."),
@@ -882,7 +3868,7 @@ def render_features_page():
     st.markdown("---")
     st.subheader("🚀 Quick Start")
     st.markdown("""
-1. **Upload** your files (Step 1) — mix CSV, Excel, JSON freely.
+1. **Upload** your files (Step 1) — mix CSV, Excel, JSON, Parquet freely.
 2. **Review mapping** (Step 2) — confirm auto-mapped columns and decide what to do with partial/unique columns.
 3. **Configure** (Step 3) — pick duplicate handling and source-file tracking.
 4. **Analyse** (Step 4) — filter, pivot, and aggregate your merged data.
@@ -914,16 +3900,35 @@ def render_sidebar():
         if st.session_state.page == 'app':
             st.markdown(f"**Current Step:** {st.session_state.step} / 5")
             if st.session_state.merged_data is not None:
-                df = st.session_state.merged_data
+                df      = st.session_state.merged_data
+                profile = get_column_profile(df)
+                nulls   = sum(profile[c]['nulls'] for c in profile.columns)
+                cells   = max(len(df) * len(profile.columns), 1)
                 st.markdown(f"**Merged rows:** {len(df):,}")
                 st.markdown(f"**Merged cols:** {len(df.columns)}")
+                st.markdown(f"**Numeric / text cols:** {len(profile.numeric_columns())} / {len(profile.other_columns())}")
+                st.markdown(f"**Empty cells:** {100 * nulls / cells:.1f}%")
+                memory = st.session_state.merged_memory
+                if memory:
+                    saved = f" (−{100 * (1 - memory[1] / memory[0]):.0f}%)" if memory[1] < memory[0] else ""
+                    st.markdown(f"**Memory:** {format_bytes(memory[0])} → {format_bytes(memory[1])}{saved}")
+                sources = st.session_state.sources
+                if any(src.memory for src in sources.values()):
+                    with st.expander("Memory per file"):
+                        for name, src in sources.items():
+                            if src.memory:
+                                st.caption(f"`{name}`: ≈{format_bytes(src.memory[0])} → ≈{format_bytes(src.memory[1])}")
 
         st.markdown("---")
         st.markdown("**Supported Formats**")
-        st.markdown("CSV · Excel · JSON · TXT")
+        st.markdown("CSV · Excel · JSON · NDJSON · TXT · Parquet · Feather")
+        missing = [m for m, version in probe_dependencies().items() if version is None]
+        if missing:
+            st.caption("⚠️ Not installed: " + ", ".join(f"`{m}` ({OPTIONAL_DEPS[m]})" for m in missing))
 
         st.markdown("---")
         if st.button("🔄 Reset Session", use_container_width=True):
+            set_merged_data(None)
             for k in list(st.session_state.keys()):
                 del st.session_state[k]
             st.rerun()
@@ -933,6 +3938,7 @@ def render_sidebar():
 # MAIN
 # ─────────────────────────────────────────
 def main():
+    sweep_stale_stores()
     render_sidebar()
 
     if st.session_state.page == 'features':
@@ -0,0 +1,257 @@
+"""
+Micro-benchmarks for File Merger Pro.
+
+Run from the repo root:
+
+    python bench.py mapping                 # column mapping on wide inputs
+    python bench.py mapping --cols 600      # ... with custom sizes
+    python bench.py analysis                # step-4 latency per interaction
+    python bench.py groupby                 # partitioned aggregation vs one pandas groupby
+    python bench.py startup                 # time-to-first-render and rerun latency
+
+Each benchmark prints one line per variant with the best-of-N wall time.
+"""
+import argparse
+import logging
+import os
+import subprocess
+import sys
+import time
+import warnings
+
+warnings.filterwarnings("ignore")
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+logging.disable(logging.WARNING)  # Streamlit's "bare mode" warnings from driving the app outside `streamlit run`
+import App  # noqa: E402  (Streamlit calls are no-ops outside `streamlit run`)
+
+
+def best_of(fn, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def report(label, seconds, baseline=None):
+    speedup = f"  ({baseline / seconds:5.1f}x)" if baseline else ""
+    print(f"  {label:<28} {seconds * 1000:10.1f} ms{speedup}")
+
+
+# ─────────────────────────────────────────
+# COLUMN MAPPING
+# ─────────────────────────────────────────
+def legacy_mapping_and_merge(dfs, mapping, add_source):
+    """The original column-by-column implementation, kept as the baseline."""
+    target_cols = list(mapping.keys())
+    frames = []
+    for fname, df in dfs.items():
+        row_df = pd.DataFrame(index=range(len(df)))
+        for tcol in target_cols:
+            scol = mapping[tcol].get(fname)
+            if scol and scol in df.columns:
+                row_df[tcol] = df[scol].values
+            else:
+                row_df[tcol] = np.nan
+        if add_source:
+            row_df['_source_file'] = fname
+        frames.append(row_df)
+    return pd.concat(frames, ignore_index=True)
+
+
+def wide_inputs(n_files, n_rows, n_cols, seed=0):
+    """Files sharing most columns; every file misses a different 10% of them."""
+    rng  = np.random.default_rng(seed)
+    cols = [f"col_{i}" for i in range(n_cols)]
+    dfs  = {}
+    for f in range(n_files):
+        keep = [c for i, c in enumerate(cols) if (i + f) % 10]
+        data = {}
+        for c in keep:
+            kind = int(c.split("_")[1]) % 3
+            if kind == 0:
+                data[c] = rng.integers(0, 1_000, n_rows)
+            elif kind == 1:
+                data[c] = rng.random(n_rows)
+            else:
+                data[c] = rng.choice(["alpha", "beta", "gamma"], n_rows).astype(object)
+        dfs[f"file_{f}.csv"] = pd.DataFrame(data)
+    mapping = {c: {fn: (c if c in df.columns else None) for fn, df in dfs.items()} for c in cols}
+    return dfs, mapping
+
+
+def bench_mapping(args):
+    dfs, mapping = wide_inputs(args.files, args.rows, args.cols)
+    print(f"mapping: {args.files} files x {args.rows:,} rows x {args.cols} columns")
+    legacy = best_of(lambda: legacy_mapping_and_merge(dfs, mapping, True), args.repeat)
+    report("legacy (insert per column)", legacy)
+    new = best_of(lambda: App.apply_mapping_and_merge(dfs, mapping, True), args.repeat)
+    report("projection + single concat", new, legacy)
+
+
+# ─────────────────────────────────────────
+# ANALYSIS PAGE
+# ─────────────────────────────────────────
+def legacy_analysis_rerun(df, filters, cat_col, pivot, group, page):
+    """What every step-4 interaction used to cost: copy, filter and recompute every section."""
+    out = df.copy()
+    for col, fval in filters.items():
+        if pd.api.types.is_numeric_dtype(out[col].dtype):
+            out = out[(out[col] >= fval[0]) & (out[col] <= fval[1])]
+        elif isinstance(fval, list) and fval:
+            out = out[out[col].isin(fval)]
+    out.iloc[(page - 1) * App.CHUNK_SIZE:page * App.CHUNK_SIZE]
+    out.select_dtypes(include='number').describe()
+    out[cat_col].value_counts()
+    pd.pivot_table(out, index=pivot[0], columns=pivot[1], values=pivot[2], aggfunc=pivot[3],
+                   margins=True, margins_name="Total")
+    out.groupby(group[0]).agg({c: group[2] for c in group[1]})
+
+
+def analysis_inputs(n_rows, seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        "region":  rng.choice(["north", "south", "east", "west"], n_rows),
+        "product": rng.choice([f"p{i}" for i in range(50)], n_rows),
+        "units":   rng.integers(1, 100, n_rows),
+        "price":   rng.random(n_rows) * 100,
+        "margin":  rng.random(n_rows),
+    })
+
+
+def bench_analysis(args):
+    df      = analysis_inputs(args.rows)
+    profile = App.ColumnProfile()
+    profile.update(df)
+    filters = {"price": (10.0, 90.0), "region": ["north", "east", "west"]}
+    pivot   = ("region", "product", "price", "sum")
+    group   = (["region", "product"], ["units", "price"], ["sum", "mean", "count"])
+    index   = App.FilterIndex(df)
+    rows    = index.rows(filters)
+    fv      = App.FilteredView(df, rows, ("bench",), profile)
+    print(f"analysis: {args.rows:,} rows — latency per interaction")
+
+    legacy = best_of(lambda: legacy_analysis_rerun(df, filters, "product", pivot, group, 2), args.repeat)
+    print(f"  before — every interaction reruns the whole page: {legacy * 1000:,.1f} ms")
+    print("  after  — only the section the widget lives in reruns:")
+    report("page the preview", best_of(lambda: App.load_columns(df, rows=rows[App.CHUNK_SIZE:2 * App.CHUNK_SIZE]),
+                                       args.repeat), legacy)
+    report("change value-count column", best_of(lambda: App.value_counts_table(fv, "region"), args.repeat), legacy)
+    report("change pivot aggregation", best_of(lambda: App.pivot_result(fv, "region", "product", "price", "mean"),
+                                               args.repeat), legacy)
+    report("change group-by functions", best_of(lambda: App.groupby_result(fv, group[0], group[1], ["max"]),
+                                                args.repeat), legacy)
+
+    def filter_change():
+        moved = App.FilteredView(df, index.rows({**filters, "price": (20.0, 80.0)}), ("bench",), profile)
+        App.load_columns(df, rows=moved.rows[:App.CHUNK_SIZE])
+        App.describe_stats(moved, profile.numeric_columns())
+        App.value_counts_table(moved, "product")
+        App.pivot_result(moved, *pivot)
+        App.groupby_result(moved, *group)
+
+    report("change a filter (full run)", best_of(filter_change, args.repeat), legacy)
+
+
+# ─────────────────────────────────────────
+# GROUP-BY
+# ─────────────────────────────────────────
+def groupby_inputs(n_rows, n_groups, seed=0):
+    """Two integer keys spanning about `n_groups` combinations, plus a float and an int value column."""
+    rng  = np.random.default_rng(seed)
+    side = max(1, int(n_groups ** 0.5))
+    return pd.DataFrame({
+        "k1": rng.integers(0, side, n_rows),
+        "k2": rng.integers(0, side, n_rows),
+        "x":  rng.random(n_rows),
+        "y":  rng.integers(0, 100, n_rows),
+    })
+
+
+def bench_groupby(args):
+    by, cols, funcs = ["k1", "k2"], ["x", "y"], ["sum", "mean", "count", "min", "max", "std"]
+    App.AGG_WORKERS = args.workers
+    print(f"groupby: {args.rows:,} rows, {len(funcs)} functions x {len(cols)} columns, "
+          f"{App.AGG_WORKERS} worker(s)")
+    for n_groups in (100, args.groups):
+        df      = groupby_inputs(args.rows, n_groups)
+        profile = App.ColumnProfile()
+        profile.update(df)
+        print(f"  ~{n_groups:,} groups:")
+        base = best_of(lambda: df.groupby(by).agg({c: funcs for c in cols}), args.repeat)
+        report("df.groupby().agg()", base)
+        fv = App.FilteredView(df, None, ("bench",), profile)
+        report("partitioned (pandas engine)", best_of(lambda: App.groupby_result(fv, by, cols, funcs), args.repeat), base)
+        if App.HAS_DUCKDB:
+            con = App.duckdb_connect(df)
+            report("duckdb", best_of(lambda: App.duckdb_groupby(con, {}, by, cols, funcs), args.repeat), base)
+
+
+# ─────────────────────────────────────────
+# STARTUP
+# ─────────────────────────────────────────
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "App.py")
+
+
+def cold_import_seconds():
+    """Import App.py in a fresh interpreter — what a cold server start pays before the first render."""
+    code = ("import logging, time; logging.disable(logging.WARNING); t = time.perf_counter(); "
+            "import App; print(time.perf_counter() - t)")
+    out = subprocess.run([sys.executable, "-c", code], cwd=os.path.dirname(APP_PATH),
+                         capture_output=True, text=True, check=True)
+    return float(out.stdout.strip().splitlines()[-1])
+
+
+def bench_startup(args):
+    from streamlit.testing.v1 import AppTest
+
+    print("startup:")
+    report("cold import of App.py", min(cold_import_seconds() for _ in range(args.repeat)))
+
+    def first_render():
+        AppTest.from_file(APP_PATH, default_timeout=120).run()
+
+    report("first render (fresh session)", best_of(first_render, args.repeat))
+    at = AppTest.from_file(APP_PATH, default_timeout=120)
+    at.run()
+    report("rerun (same session)", best_of(at.run, args.repeat))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub    = parser.add_subparsers(dest="bench", required=True)
+
+    p = sub.add_parser("mapping", help="apply_mapping_and_merge on wide inputs")
+    p.add_argument("--files",  type=int, default=10)
+    p.add_argument("--rows",   type=int, default=20_000)
+    p.add_argument("--cols",   type=int, default=300)
+    p.add_argument("--repeat", type=int, default=3)
+    p.set_defaults(func=bench_mapping)
+
+    p = sub.add_parser("analysis", help="step-4 latency per interaction, before/after fragments")
+    p.add_argument("--rows",   type=int, default=2_000_000)
+    p.add_argument("--repeat", type=int, default=3)
+    p.set_defaults(func=bench_analysis)
+
+    p = sub.add_parser("groupby", help="partitioned group-by vs a single df.groupby().agg()")
+    p.add_argument("--rows",   type=int, default=4_000_000)
+    p.add_argument("--groups", type=int, default=800_000)
+    p.add_argument("--workers", type=int, default=App.AGG_WORKERS)
+    p.add_argument("--repeat", type=int, default=3)
+    p.set_defaults(func=bench_groupby)
+
+    p = sub.add_parser("startup", help="time-to-first-render and rerun latency of the app script")
+    p.add_argument("--repeat", type=int, default=5)
+    p.set_defaults(func=bench_startup)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()